@@ -0,0 +1,81 @@
+import time
+
+ANSWER_START_TAG = "<answer>"
+ANSWER_END_TAG = "</answer>"
+
+class AnswerStreamReader:
+    """
+    Accumulates the chunks of a streamed chat completion and reports when
+    the closing answer tag has been emitted, so the caller can close the
+    stream instead of paying for everything the model says afterwards.
+    Also measures time to first token, counting from construction.
+    """
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        self.start = time.perf_counter()
+        self.ttft = None
+        self.text = ""
+        self.streamed_tokens = 0
+        self.finish_reason = None
+        self.stopped_at_answer = False
+        self.usage = None
+
+    def feed(self, chunk) -> bool:
+        """
+        Add one stream chunk. Returns True once the answer is complete
+        and the rest of the stream should be dropped.
+        """
+        if getattr(chunk, "usage", None) is not None:
+            # only sent with the final chunk, i.e. when the stream was not cut short
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return False
+        choice = chunk.choices[0]
+        if choice.finish_reason is not None:
+            self.finish_reason = choice.finish_reason
+        delta = choice.delta.content if choice.delta is not None else None
+        if not delta:
+            return False
+
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.start
+        # OpenAI-compatible servers send roughly one token per chunk
+        self.streamed_tokens += 1
+
+        # only the new text plus a tag's length before it can complete the tag
+        search_from = max(len(self.text) - len(ANSWER_END_TAG), 0)
+        self.text += delta
+        tag_pos = self.text.find(ANSWER_END_TAG, search_from)
+        if tag_pos == -1:
+            return False
+        self.text = self.text[:tag_pos + len(ANSWER_END_TAG)]
+        self.stopped_at_answer = True
+        return True
+
+    def result(self) -> tuple[str, dict]:
+        text = self.text
+        if not self.stopped_at_answer and self.finish_reason == "stop" and has_open_answer(text):
+            # the server ended on the stop sequence, which it leaves out of the output
+            text += ANSWER_END_TAG
+            self.stopped_at_answer = True
+        metrics = {
+            "prompt_tokens": self.usage.prompt_tokens if self.usage is not None else None,
+            "completion_tokens": self.usage.completion_tokens if self.usage is not None else self.streamed_tokens,
+            "cached_prompt_tokens": cached_prompt_tokens(self.usage),
+            "ttft": self.ttft,
+            "streamed_tokens": self.streamed_tokens,
+            "stopped_at_answer": self.stopped_at_answer,
+            # unused part of max_tokens, an upper bound on what stopping early avoided
+            "budget_remaining": self.max_tokens - self.streamed_tokens if self.stopped_at_answer else 0,
+        }
+        return text, metrics
+
+
+def cached_prompt_tokens(usage) -> int | None:
+    """Prompt tokens the server served from its prefix cache, if it reports them."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None)
+
+
+def has_open_answer(text: str) -> bool:
+    return text.rfind(ANSWER_START_TAG) > text.rfind(ANSWER_END_TAG)
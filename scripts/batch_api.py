@@ -0,0 +1,184 @@
+from pathlib import Path
+import sys
+import json
+from openai.types.chat import ChatCompletion
+
+# add project root to Python path to allow imports
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from scripts.output_records import append_record, completed_ids, is_failure, open_for_append
+from scripts.mock_server import process_batch
+from scripts.output_store import new_run_id, store_run
+from scripts.run_bench import (
+    MODEL_OUTPUTS_DIR, build_messages, completion_kwargs, load_benchmark, make_result,
+    output_path, pending_prompts, prompt_id, usage_metrics,
+)
+
+BATCH_DIR = project_root / "batch_requests"
+
+# Endpoint every batch request is sent to
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+def batch_input_path(model: str, method: str, size: int, batch_dir: Path = BATCH_DIR) -> Path:
+    return batch_dir / f"{model}_{method}_{size}_input.jsonl"
+
+
+def batch_output_path(model: str, method: str, size: int, batch_dir: Path = BATCH_DIR) -> Path:
+    return batch_dir / f"{model}_{method}_{size}_output.jsonl"
+
+
+def export_batch(model: str, method: str, size: int, batch_dir: Path = BATCH_DIR, outputs_dir: Path = MODEL_OUTPUTS_DIR) -> Path:
+    """
+    Write the prompts of a benchmark that have no result yet as a Batch API
+    input file, one request per line with the prompt id as its custom_id,
+    and return its path. Requests carry the body run_bench sends, so batch
+    and online results are interchangeable.
+    """
+    pending = pending_prompts(model, method, size, outputs_dir)
+    path = batch_input_path(model, method, size, batch_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        for _, pid, item in pending:
+            body = completion_kwargs(model, build_messages(item))
+            # the Batch API validates bodies strictly and rejects an empty
+            # tools list, which is the same as sending no tools at all
+            if not body["tools"]:
+                del body["tools"], body["tool_choice"]
+            request = {"custom_id": pid, "method": "POST", "url": BATCH_ENDPOINT, "body": body}
+            f.write(json.dumps(request) + "\n")
+    print(f"Exported {len(pending)} {method} requests to {path}")
+    return path
+
+
+def batch_line_result(line: dict) -> tuple[str | None, dict]:
+    """
+    Model output and metrics of one line of a Batch API output or error
+    file. A request that failed gets an error in its metrics instead.
+    """
+    response = line.get("response") or {}
+    if line.get("error") is not None:
+        error = line["error"]
+        return None, {"error": f"{error.get('code')}: {error.get('message')}"}
+    if response.get("status_code") != 200:
+        error = (response.get("body") or {}).get("error") or {}
+        return None, {"error": f"HTTP {response.get('status_code')}: {error.get('message')}"}
+
+    completion = ChatCompletion.model_validate(response["body"])
+    metrics = usage_metrics(completion.usage)
+    metrics["batch_request_id"] = line.get("id")
+    return completion.choices[0].message.content, metrics
+
+
+def ingest_batch(model: str, method: str, size: int, results_file: Path, outputs_dir: Path = MODEL_OUTPUTS_DIR, run_id: str | None = None) -> list[dict]:
+    """
+    Append the results of a Batch API output (or error) file to the run's
+    output file, matching custom_ids back to the benchmark prompts. Results
+    for prompts that already have one, or whose id no longer matches the
+    benchmark, are skipped, so ingesting a file twice is harmless. Failed
+    requests are recorded with their error and exported again next time.
+    Records are tagged with run_id, a timestamp unless given, and copied
+    into the parquet output store under it, as run_bench does.
+    """
+    run_id = run_id or new_run_id()
+    benchmark_items = {prompt_id(idx, item): item for idx, item in enumerate(load_benchmark(method, size))}
+    path = output_path(model, method, size, outputs_dir)
+    done = completed_ids(path)
+
+    results, unknown = [], 0
+    with open(results_file, "r") as f_in, open_for_append(path) as f_out:
+        for line in f_in:
+            if not line.strip():
+                continue
+            line = json.loads(line)
+            pid = line["custom_id"]
+            if pid not in benchmark_items:
+                unknown += 1
+                continue
+            if pid in done:
+                continue
+            model_output, metrics = batch_line_result(line)
+            result = make_result(pid, benchmark_items[pid], model_output, {"cached": False, **metrics}, run_id)
+            append_record(f_out, result)
+            results.append(result)
+            if model_output is not None:
+                done.add(pid)
+
+    print(f"Ingested {len(results)} {method} results from {results_file}")
+    if unknown:
+        print(f"Skipped {unknown} results whose custom_id is not in benchmark_{method}_{size}.json")
+    failed = sum(1 for result in results if is_failure(result))
+    if failed:
+        print(f"{failed}/{len(results)} batch requests failed; export the benchmark again to retry them")
+    store_run(model, method, size, run_id, outputs_dir)
+    return results
+
+
+def run_mock_batches(model: str, size: int, error_rate: float = 0.0, batch_dir: Path = BATCH_DIR, outputs_dir: Path = MODEL_OUTPUTS_DIR, run_id: str | None = None) -> None:
+    """
+    Export, process with the offline mock_server batch processor, and
+    ingest every method's benchmark, as one run with id run_id.
+    """
+    run_id = run_id or new_run_id()
+    for method in ['base', 'cot', 'react', 'scope']:
+        input_file = export_batch(model, method, size, batch_dir, outputs_dir)
+        output_file = batch_output_path(model, method, size, batch_dir)
+        process_batch(input_file, output_file, error_rate)
+        ingest_batch(model, method, size, output_file, outputs_dir, run_id)
+
+
+def print_usage() -> None:
+    print(
+"""Usage: python batch_api.py <export|ingest|mock> [options]
+Commands:
+  export - Write a Batch API input file per method for the prompts without a result
+  ingest - Append a Batch API output or error file to the method's model outputs
+  mock - Export, process offline with the mock batch processor and ingest every method
+Arguments:
+  --model <model> - Model name used in file names and request bodies (defaults to tei)
+  --size | -n <size> - Benchmark size (defaults to 100)
+  --method | -m <method> - Method to export or ingest (export defaults to every method; required for ingest)
+  --results | -r <path> - Batch output file to ingest (defaults to the mock processor's output file)
+  --error-rate <fraction> - Fraction of requests the mock processor fails (defaults to 0)
+Example usage: python batch_api.py ingest --model gpt-4o-mini --size 100 --method scope --results batch_abc_output.jsonl"""
+    )
+
+
+def parse_args() -> tuple[str, dict]:
+    args = sys.argv[1:]
+    if not args or args[0] not in ("export", "ingest", "mock"):
+        print_usage()
+        sys.exit(1)
+    options = {
+        "--model": ("model", str),
+        "--size": ("size", int), "-n": ("size", int),
+        "--method": ("method", str), "-m": ("method", str),
+        "--results": ("results_file", Path), "-r": ("results_file", Path),
+        "--error-rate": ("error_rate", float),
+    }
+    config = {"model": "tei", "size": 100}
+    for i in range(1, len(args), 2):
+        if args[i] not in options or i + 1 >= len(args):
+            print(f"Error: Invalid argument: {args[i]}\n")
+            print_usage()
+            sys.exit(1)
+        key, convert = options[args[i]]
+        config[key] = convert(args[i+1])
+    return args[0], config
+
+
+if __name__ == "__main__":
+    command, config = parse_args()
+    if command == "export":
+        methods = [config["method"]] if "method" in config else ['base', 'cot', 'react', 'scope']
+        for method in methods:
+            export_batch(config["model"], method, config["size"])
+    elif command == "ingest":
+        if "method" not in config:
+            print("Error: ingest needs --method\n")
+            print_usage()
+            sys.exit(1)
+        results_file = config.get("results_file") or batch_output_path(config["model"], config["method"], config["size"])
+        ingest_batch(config["model"], config["method"], config["size"], results_file)
+    else:
+        run_mock_batches(config["model"], config["size"], config.get("error_rate", 0.0))
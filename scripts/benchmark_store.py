@@ -0,0 +1,213 @@
+from pathlib import Path
+import hashlib
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Fields stored for every benchmark row. The prompt itself is not stored:
+# it is rendered from the benchmark's template, and for SCOPE from the
+# schema and worked example the row refers to, which are stored once
+BENCHMARK_ROW_SCHEMA = pa.schema([
+    ("algorithm", pa.string()),
+    ("category", pa.string()),
+    ("algorithm_name", pa.string()),
+    ("question", pa.string()),
+    ("answer", pa.string()),
+    ("example_output_A", pa.string()),
+    ("example_output_B", pa.string()),
+    ("schema_key", pa.string()),
+    ("example_key", pa.string()),
+])
+
+def benchmark_file(bench_dir: Path, method: str, size: int) -> Path:
+    """
+    Return the benchmark file for a (method, size) pair. Prefer the compact
+    parquet file written by make_bench, falling back to a fully rendered
+    JSON file if only that exists.
+    """
+    compact_file = bench_dir / f"benchmark_{method}_{size}.parquet"
+    json_file = compact_file.with_suffix(".json")
+    if not compact_file.exists() and json_file.exists():
+        return json_file
+    return compact_file
+
+
+def encode_compact_rows(rows: list[dict]) -> pa.Table:
+    return pa.Table.from_pylist(rows, schema=BENCHMARK_ROW_SCHEMA)
+
+
+def encode_json_rows(template: str, rows: list[dict], schemas: dict[str, str] | None = None, examples: dict[str, str] | None = None) -> list[str]:
+    # elements of a top-level array are indented by one level
+    return [
+        json.dumps(item, indent=2).replace("\n", "\n  ")
+        for item in render_benchmark(template, rows, schemas, examples)
+    ]
+
+
+class CompactBenchmarkWriter:
+    """
+    Writes benchmark rows to a parquet file as they are produced, with the
+    prompt template and the schemas and worked examples keyed by the rows'
+    schema_key and example_key stored once in the file's metadata.
+    """
+    def __init__(self, path: Path, template: str, schemas: dict[str, str] | None = None, examples: dict[str, str] | None = None):
+        metadata = {
+            "template": template,
+            "schemas": json.dumps(schemas or {}),
+            "examples": json.dumps(examples or {}),
+        }
+        self.schema = BENCHMARK_ROW_SCHEMA.with_metadata(metadata)
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows: list[dict]) -> None:
+        self.write_encoded(encode_compact_rows(rows))
+
+    def write_encoded(self, table: pa.Table) -> None:
+        """Append rows already encoded by encode_compact_rows, e.g. in another process."""
+        self.writer.write_table(table.replace_schema_metadata(self.schema.metadata))
+
+    def close(self) -> None:
+        self.writer.close()
+
+    def __enter__(self) -> "CompactBenchmarkWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class JsonBenchmarkWriter:
+    """
+    Writes benchmark rows fully rendered, producing the same bytes as
+    json.dump(render_benchmark(...), f, indent=2) one row at a time.
+    """
+    def __init__(self, path: Path, template: str, schemas: dict[str, str] | None = None, examples: dict[str, str] | None = None):
+        self.template = template
+        self.schemas = schemas
+        self.examples = examples
+        self.f = open(path, "w")
+        self.f.write("[")
+        self.empty = True
+
+    def write(self, rows: list[dict]) -> None:
+        self.write_encoded(encode_json_rows(self.template, rows, self.schemas, self.examples))
+
+    def write_encoded(self, elements: list[str]) -> None:
+        """Append rows already rendered by encode_json_rows, e.g. in another process."""
+        for element in elements:
+            self.f.write(("\n  " if self.empty else ",\n  ") + element)
+            self.empty = False
+
+    def close(self) -> None:
+        self.f.write("]" if self.empty else "\n]")
+        self.f.close()
+
+    def __enter__(self) -> "JsonBenchmarkWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def write_compact_benchmark(path: Path, template: str, rows: list[dict], schemas: dict[str, str] | None = None, examples: dict[str, str] | None = None) -> None:
+    with CompactBenchmarkWriter(path, template, schemas, examples) as writer:
+        writer.write(rows)
+
+
+def load_compact_benchmark(path: Path) -> list[dict]:
+    """
+    Read a compact benchmark. Every item refers to the same template,
+    schema and worked example strings instead of holding a rendered
+    prompt; render_prompt builds the prompt when it is needed. Items also
+    carry a digest of those shared strings, for prompt_digest.
+    """
+    table = pq.read_table(path)
+    metadata = {key.decode("utf-8"): value.decode("utf-8") for key, value in table.schema.metadata.items()}
+    template = metadata["template"]
+    schemas = json.loads(metadata["schemas"])
+    examples = json.loads(metadata["examples"])
+    shared_digest = hashlib.sha1(json.dumps([template, schemas, examples], sort_keys=True).encode("utf-8")).hexdigest()
+    items = table.to_pylist()
+    for item in items:
+        item["template"] = template
+        item["algorithm_schema"] = schemas.get(item["schema_key"], "")
+        item["worked_example"] = examples.get(item["example_key"], "")
+        item["shared_digest"] = shared_digest
+    return items
+
+
+def read_benchmark(bench_dir: Path, method: str, size: int) -> list[dict]:
+    path = benchmark_file(bench_dir, method, size)
+    if path.suffix == ".json":
+        with open(path, "r") as f:
+            return json.load(f)
+    return load_compact_benchmark(path)
+
+
+def render_prompt(item: dict) -> str:
+    """Prompt of a benchmark item, rendering it from its template if it is not stored rendered."""
+    if "prompt" in item:
+        return item["prompt"]
+    # templates without schema or worked example placeholders ignore them
+    return item["template"].format(
+        algorithm_name=item["algorithm_name"],
+        question=item["question"],
+        example_output_A=item["example_output_A"],
+        example_output_B=item["example_output_B"],
+        worked_example=item["worked_example"],
+        algorithm_schema=item["algorithm_schema"],
+    )
+
+
+def prompt_digest(item: dict) -> str:
+    """
+    Digest that changes whenever a benchmark item's prompt does. A compact
+    item is hashed from the row fields its prompt is rendered from and the
+    digest of its benchmark's shared strings, so that the prompt is not
+    rendered just to identify it; a fully rendered item hashes its prompt.
+    """
+    if "prompt" in item:
+        return hashlib.sha1(item["prompt"].encode("utf-8")).hexdigest()
+    fields = [item[field] for field in ("shared_digest", "schema_key", "example_key", "algorithm_name", "question", "example_output_A", "example_output_B")]
+    return hashlib.sha1(json.dumps(fields).encode("utf-8")).hexdigest()
+
+
+def prompt_id(idx: int, item: dict) -> str:
+    """
+    Stable ID for a benchmark prompt: its position in the benchmark plus a
+    digest of the prompt, so that a regenerated benchmark never reuses
+    results from a different prompt at the same position.
+    """
+    return f"{idx:06d}-{prompt_digest(item)[:12]}"
+
+
+def benchmark_items_by_id(bench_dir: Path, method: str, size: int) -> dict[str, dict] | None:
+    """
+    The items of a benchmark keyed by prompt id, or None if the benchmark
+    has not been built. Output files are appended to across benchmark
+    builds, so readers use these ids to tell the current build's records
+    from stale ones.
+    """
+    if not benchmark_file(bench_dir, method, size).exists():
+        return None
+    return {prompt_id(idx, item): item for idx, item in enumerate(read_benchmark(bench_dir, method, size))}
+
+
+def render_benchmark(template: str, rows: list[dict], schemas: dict[str, str] | None = None, examples: dict[str, str] | None = None) -> list[dict]:
+    """Render benchmark rows into the fully rendered JSON benchmark format."""
+    dataset = []
+    for row in rows:
+        prompt = render_prompt({
+            **row,
+            "template": template,
+            "algorithm_schema": (schemas or {}).get(row.get("schema_key"), ""),
+            "worked_example": (examples or {}).get(row.get("example_key"), ""),
+        })
+        dataset.append({
+            "algorithm": row["algorithm"],
+            "category": row["category"],
+            "prompt": prompt,
+            "question": row["question"],
+            "answer": row["answer"],
+        })
+    return dataset
@@ -0,0 +1,88 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import time
+import pandas as pd
+
+project_root = Path(__file__).parent.parent
+
+DATASET_CACHE_DIR = project_root / ".cache" / "datasets"
+
+# Bump whenever the processing pipeline changes in a way that changes its
+# output, so that stale processed datasets are never served from the cache
+PIPELINE_VERSION = 1
+
+def shard_checksum(path: Path) -> str:
+    """
+    Checksum of a source shard. Files in a huggingface snapshot are
+    symlinks to blobs named by the sha256 of their contents, so the blob
+    name is used directly; any other file is hashed.
+    """
+    resolved = Path(path).resolve()
+    if resolved.parent.name == "blobs":
+        return resolved.name
+    digest = hashlib.sha256()
+    with open(resolved, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def dataset_params(fetch_counts: dict[str, int], num_rows: int, seed: int | None) -> dict:
+    return {
+        "fetch_counts": {pt: int(count) for pt, count in sorted(fetch_counts.items()) if int(count) > 0},
+        "num_rows": num_rows,
+        "seed": seed,
+        "pipeline_version": PIPELINE_VERSION,
+    }
+
+
+def dataset_cache_key(shards: dict[str, str], params: dict) -> str:
+    payload = json.dumps({"shards": shards, **params}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def load_cached_dataset(key: str) -> pd.DataFrame | None:
+    entry_dir = DATASET_CACHE_DIR / key
+    if not (entry_dir / "manifest.json").exists():
+        return None
+    return pd.read_parquet(entry_dir / "dataset.parquet")
+
+
+def find_cached_dataset(params: dict) -> pd.DataFrame | None:
+    """
+    Look up a processed dataset by its parameters alone, for when the source
+    shards are not available to checksum. Returns the most recently created
+    match, if any.
+    """
+    if not DATASET_CACHE_DIR.exists():
+        return None
+    matches = []
+    for entry in os.listdir(DATASET_CACHE_DIR):
+        manifest_file = DATASET_CACHE_DIR / entry / "manifest.json"
+        if not manifest_file.exists():
+            continue
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+        if manifest["params"] == params:
+            matches.append((manifest["created"], manifest["key"]))
+    if not matches:
+        return None
+    return load_cached_dataset(max(matches)[1])
+
+
+def store_cached_dataset(key: str, df: pd.DataFrame, shards: dict[str, str], params: dict) -> None:
+    entry_dir = DATASET_CACHE_DIR / key
+    entry_dir.mkdir(parents=True, exist_ok=True)
+    # write the dataset before the manifest, so an entry with a manifest is always complete
+    df.to_parquet(entry_dir / "dataset.parquet")
+    manifest = {
+        "key": key,
+        "params": params,
+        "shards": shards,
+        "num_rows_stored": len(df),
+        "created": time.time(),
+    }
+    with open(entry_dir / "manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2)
@@ -0,0 +1,137 @@
+import time
+from typing import Any, Awaitable, Callable
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, RateLimitError
+from scripts.flow_control import is_transient
+
+# Consecutive failed requests after which an endpoint is drained
+FAILURE_THRESHOLD = 3
+
+# Seconds a drained endpoint receives no new requests before it is tried again
+DRAIN_COOLDOWN = 30.0
+
+def make_async_client(base_url: str, api_key: str, concurrency: int) -> AsyncOpenAI:
+    # size the connection pool to the concurrency limit so that every
+    # in-flight request reuses a kept-alive connection
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return AsyncOpenAI(
+        base_url=base_url,
+        api_key=api_key,
+        http_client=DefaultAsyncHttpxClient(limits=limits),
+        # retries are left to flow_control, which backs off across endpoints
+        max_retries=0,
+    )
+
+
+class Endpoint:
+    """One replica: its own client and connection pool, load and health."""
+    def __init__(self, base_url: str, api_key: str, concurrency: int):
+        self.base_url = base_url
+        self.client = make_async_client(base_url, api_key, concurrency)
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.drained_until = 0.0
+        self.served = 0
+        self.failed = 0
+        self.drains = 0
+
+    def available(self, now: float) -> bool:
+        return self.drained_until <= now
+
+
+class EndpointPool:
+    """
+    Spreads requests over several OpenAI-compatible replicas of the same
+    model. Each request goes to the available endpoint with the fewest
+    requests outstanding. An endpoint failing FAILURE_THRESHOLD requests in
+    a row is drained for DRAIN_COOLDOWN seconds, unless it is the last one
+    available, and a failed request is retried on the endpoints it has not
+    been tried on yet, so the work finishes on the healthy replicas. After
+    its cooldown a drained endpoint gets requests again, and a single
+    further failure drains it anew.
+    """
+    def __init__(self, base_urls: list[str], api_key: str, concurrency: int):
+        if not base_urls:
+            raise ValueError("At least one endpoint is required")
+        self.endpoints = [Endpoint(base_url, api_key, concurrency) for base_url in base_urls]
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    @property
+    def base_url(self) -> str:
+        # replicas serve the same model, so responses are shared between
+        # them whatever order the endpoints were listed in. The clients'
+        # normalized urls are used, so that a pool of one endpoint shares
+        # cache keys with a plain OpenAI client for it
+        return ",".join(sorted(str(endpoint.client.base_url) for endpoint in self.endpoints))
+
+    def acquire(self, tried: list[Endpoint]) -> Endpoint:
+        now = time.monotonic()
+        untried = [endpoint for endpoint in self.endpoints if endpoint not in tried]
+        # fall back to drained endpoints before giving up on the request
+        candidates = [endpoint for endpoint in untried if endpoint.available(now)] or untried
+        return min(candidates, key=lambda endpoint: endpoint.outstanding)
+
+    def record_success(self, endpoint: Endpoint) -> None:
+        endpoint.served += 1
+        endpoint.consecutive_failures = 0
+
+    def record_failure(self, endpoint: Endpoint) -> None:
+        endpoint.failed += 1
+        endpoint.consecutive_failures += 1
+        now = time.monotonic()
+        others_available = any(other.available(now) for other in self.endpoints if other is not endpoint)
+        if endpoint.consecutive_failures >= FAILURE_THRESHOLD and endpoint.available(now) and others_available:
+            endpoint.drained_until = now + DRAIN_COOLDOWN
+            endpoint.drains += 1
+            print(f"Draining endpoint {endpoint.base_url} after {endpoint.consecutive_failures} consecutive failures")
+
+    async def run(self, request: Callable[[AsyncOpenAI], Awaitable[Any]]) -> tuple[Any, str]:
+        """
+        Await request(client) on the least loaded available endpoint, failing
+        over to the other endpoints if it raises a transient error. Returns
+        the result and the base url of the endpoint that produced it; raises
+        any other error at once, and the last error once every endpoint has
+        failed the request.
+        """
+        tried = []
+        while True:
+            endpoint = self.acquire(tried)
+            tried.append(endpoint)
+            endpoint.outstanding += 1
+            try:
+                result = await request(endpoint.client)
+            except RateLimitError:
+                # a busy replica is not an unhealthy one; send the request elsewhere
+                if len(tried) == len(self.endpoints):
+                    raise
+                continue
+            except Exception as e:
+                # a bad request fails on every replica and says nothing about this one's health
+                if not is_transient(e):
+                    raise
+                self.record_failure(endpoint)
+                if len(tried) == len(self.endpoints):
+                    raise
+                continue
+            finally:
+                endpoint.outstanding -= 1
+            self.record_success(endpoint)
+            return result, endpoint.base_url
+
+    def stats(self) -> list[dict]:
+        return [
+            {"endpoint": endpoint.base_url, "served": endpoint.served, "failed": endpoint.failed, "drains": endpoint.drains}
+            for endpoint in self.endpoints
+        ]
+
+    async def close(self) -> None:
+        for endpoint in self.endpoints:
+            await endpoint.client.close()
+
+    async def __aenter__(self) -> "EndpointPool":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
@@ -1,36 +1,272 @@
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import re
+import hashlib
 import json
+import multiprocessing
+import os
+import re
+import sys
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from scripts.benchmark_store import benchmark_items_by_id
+from scripts.output_records import count_failures, iter_outputs, output_file
+from scripts.output_store import OUTPUT_STORE_DIR, load_outputs
 
+BENCH_DIR = project_root / "benchmark_datasets"
 OUTPUTS_DIR = project_root / "model_outputs"
+SCORE_CACHE_FILE = project_root / ".cache" / "eval_scores.json"
+
+# Also applied by pyarrow's RE2 kernels, so keep it within the syntax both support
+ANSWER_TAG_PATTERN = re.compile(r"<answer>(?P<ans>.*)</answer>")
+
+# Matches output files named {model}_{method}_{size}.json(l)
+OUTPUT_FILE_PATTERN = re.compile(r"(?P<model>.+)_(?P<method>base|cot|react|scope)_(?P<size>\d+)\.jsonl?")
 
-ANSWER_TAG_PATTERN = re.compile(r"<answer>(?<ans>.*)</answer>")
+SCORE_COLUMNS = ["category", "algorithm", "correct", "total"]
+
+# Bump whenever scoring changes in a way that changes scores, so that the
+# score cache never serves scores computed by an older scorer
+SCORER_VERSION = 1
 
 def exact_match(model_answer: str, correct_answer: str) -> bool:
-    def strip_answer_tags(text: str) -> str:
-        return ANSWER_TAG_PATTERN.search(text).group("ans")
-    return strip_answer_tags(model_answer).strip() == correct_answer.strip()
+    def strip_answer_tags(text: str) -> str | None:
+        matched = ANSWER_TAG_PATTERN.search(text)
+        return None if matched is None else matched.group("ans")
+    model_answer = strip_answer_tags(model_answer)
+    if model_answer is None:
+        # an output without answer tags can never be correct
+        return False
+    return model_answer.strip() == correct_answer.strip()
+
+
+def current_prompt_ids(method: str, size: int) -> set[str] | None:
+    """Prompt ids of the current build of a benchmark, or None to read every record if it is not built."""
+    items = benchmark_items_by_id(BENCH_DIR, method, size)
+    return None if items is None else set(items)
+
+
+def count_correct(model: str, method: str, size: int) -> tuple[int, int]:
+    """
+    Number of correct model outputs of a run, and of outputs scored. Failed
+    requests and records of earlier benchmark builds are left out.
+    """
+    num_correct, num_outputs = 0, 0
+    for output in iter_outputs(output_file(OUTPUTS_DIR, model, method, size), current_prompt_ids(method, size)):
+        num_correct += 1 if exact_match(output["model_output"], output["answer"]) else 0
+        num_outputs += 1
+    return num_correct, num_outputs
 
 
 def evaluate_bench(model: str, method: str, size: int) -> float:
-    with open(OUTPUTS_DIR / f"{model}_{method}_{size}.json", "r") as f:
-        outputs = json.load(f)
+    num_correct, num_outputs = count_correct(model, method, size)
+    # a run whose requests all failed has nothing to score
+    if num_outputs == 0:
+        return 0.0
+    return float(num_correct) / num_outputs
 
-    num_correct = sum(
-        1 if exact_match(output["model_output"], output["answer"]) else 0
-        for output in outputs
+
+def score_outputs(outputs: pd.DataFrame) -> pd.Series:
+    """
+    Vectorized exact_match over the model_output and answer columns:
+    extract the answer tags, trim whitespace on both sides and compare.
+    Outputs without answer tags score as incorrect.
+    """
+    model_outputs = pa.array(outputs["model_output"], type=pa.string())
+    extracted = pc.struct_field(pc.extract_regex(model_outputs, pattern=ANSWER_TAG_PATTERN.pattern), [0])
+    model_answers = pc.utf8_trim_whitespace(extracted)
+    answers = pc.utf8_trim_whitespace(pa.array(outputs["answer"], type=pa.string()))
+    matches = pc.fill_null(pc.equal(model_answers, answers), False)
+    return pd.Series(matches.to_numpy(zero_copy_only=False), index=outputs.index)
+
+
+def score_file(path: Path, prompt_ids: set[str] | None = None) -> list[dict]:
+    """
+    Score every model output in an output file and return correct/total
+    counts per (category, algorithm). Failed requests are left out, and
+    given prompt_ids so are the records of other benchmark builds.
+    """
+    outputs = pd.DataFrame.from_records(
+        list(iter_outputs(path, prompt_ids)),
+        columns=["category", "algorithm", "answer", "model_output"],
     )
+    outputs["correct"] = score_outputs(outputs)
+    scores = outputs.groupby(["category", "algorithm"], dropna=False)["correct"].agg(correct="sum", total="size")
+    return [
+        {"category": category, "algorithm": algorithm, "correct": int(row.correct), "total": int(row.total)}
+        for (category, algorithm), row in scores.iterrows()
+    ]
+
+
+def file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def discover_output_files(outputs_dir: Path = OUTPUTS_DIR) -> list[tuple[str, str, int, Path]]:
+    """
+    Find every (model, method, size) run under outputs_dir, preferring the
+    JSONL file of a run over its legacy JSON file when both exist.
+    """
+    runs = set()
+    for entry in os.listdir(outputs_dir):
+        matched = OUTPUT_FILE_PATTERN.fullmatch(entry)
+        if matched is not None:
+            runs.add((matched.group("model"), matched.group("method"), int(matched.group("size"))))
+    return [
+        (model, method, size, output_file(outputs_dir, model, method, size))
+        for model, method, size in sorted(runs)
+    ]
+
+
+def load_score_cache() -> dict:
+    if not SCORE_CACHE_FILE.exists():
+        return {}
+    with open(SCORE_CACHE_FILE, "r") as f:
+        return json.load(f)
 
-    return float(num_correct) / len(outputs)
+
+def save_score_cache(score_cache: dict) -> None:
+    SCORE_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with open(SCORE_CACHE_FILE, "w") as f:
+        json.dump(score_cache, f)
+
+
+def prompt_ids_digest(prompt_ids: set[str] | None) -> str | None:
+    if prompt_ids is None:
+        return None
+    return hashlib.sha256("\n".join(sorted(prompt_ids)).encode("utf-8")).hexdigest()
+
+
+def cached_scores(score_cache: dict, path: Path, benchmark_digest: str | None) -> list[dict] | None:
+    """
+    Return the cached scores for path if the file is unchanged: same mtime
+    and size, or failing that the same content hash, and was scored by
+    the current scorer against the same benchmark build.
+    """
+    entry = score_cache.get(str(path))
+    if entry is None or entry.get("scorer_version") != SCORER_VERSION or entry.get("benchmark") != benchmark_digest:
+        return None
+    stat = path.stat()
+    if entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+        return entry["scores"]
+    if entry["sha256"] == file_digest(path):
+        entry["mtime_ns"], entry["size"] = stat.st_mtime_ns, stat.st_size
+        return entry["scores"]
+    return None
+
+
+def evaluate_sweep(outputs_dir: Path = OUTPUTS_DIR, num_workers: int | None = None) -> pd.DataFrame:
+    """
+    Score every output file under outputs_dir, in parallel across files,
+    reusing the scores of files that have not changed since the last
+    evaluation. Only records of the current benchmark builds are scored.
+    Returns one row per (model, method, size, category, algorithm) with
+    correct/total counts and accuracy.
+    """
+    runs = discover_output_files(outputs_dir)
+    score_cache = load_score_cache()
+    # models run on the same benchmarks, so read each one once
+    prompt_ids = {key: current_prompt_ids(*key) for key in {(method, size) for _, method, size, _ in runs}}
+    run_prompt_ids = {path: prompt_ids[method, size] for _, method, size, path in runs}
+    digests = {path: prompt_ids_digest(ids) for path, ids in run_prompt_ids.items()}
+
+    scores = {path: cached_scores(score_cache, path, digests[path]) for _, _, _, path in runs}
+    stale = [path for path, file_scores in scores.items() if file_scores is None]
+    if stale:
+        print(f"Scoring {len(stale)} output files ({len(runs) - len(stale)} unchanged)...")
+        # spawn rather than fork, so that workers do not inherit the
+        # parent's pyarrow thread pools mid-use
+        mp_context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context) as pool:
+            for path, file_scores in zip(stale, pool.map(score_file, stale, [run_prompt_ids[path] for path in stale])):
+                scores[path] = file_scores
+                stat = path.stat()
+                score_cache[str(path)] = {
+                    "mtime_ns": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "sha256": file_digest(path),
+                    "scorer_version": SCORER_VERSION,
+                    "benchmark": digests[path],
+                    "scores": file_scores,
+                }
+    save_score_cache(score_cache)
+
+    rows = [
+        {"model": model, "method": method, "size": size, **row}
+        for model, method, size, path in runs
+        for row in scores[path]
+    ]
+    results = pd.DataFrame(rows, columns=["model", "method", "size", *SCORE_COLUMNS])
+    results["accuracy"] = results["correct"] / results["total"]
+    return results
+
+
+def evaluate_store(store_dir: Path = OUTPUT_STORE_DIR) -> pd.DataFrame:
+    """
+    Score every run in the parquet output store with one columnar scan.
+    Returns the rows of evaluate_sweep with the run id of each run.
+    """
+    keys = ["model", "method", "size", "run_id", "category", "algorithm"]
+    outputs = load_outputs(store_dir, columns=[*keys, "answer", "model_output", "error"]).to_pandas()
+    outputs = outputs[outputs["error"].isna()]
+    outputs["correct"] = score_outputs(outputs)
+    results = outputs.groupby(keys, dropna=False, observed=True)["correct"].agg(correct="sum", total="size").reset_index()
+    results["accuracy"] = results["correct"] / results["total"]
+    return results
+
+
+def accuracy_table(results: pd.DataFrame, by: list[str]) -> pd.DataFrame:
+    """
+    Aggregate the rows of evaluate_sweep over the given columns and pivot
+    methods into columns of accuracies.
+    """
+    grouped = results.groupby(by + ["method"], dropna=False)[["correct", "total"]].sum()
+    accuracy = (grouped["correct"] / grouped["total"]).rename("accuracy")
+    return accuracy.unstack("method")
+
+
+def main_sweep(outputs_dir: Path = OUTPUTS_DIR, save_path: Path | None = None) -> None:
+    print(f"Evaluating every run under {outputs_dir}...")
+    results = evaluate_sweep(outputs_dir)
+    with pd.option_context("display.max_rows", None, "display.float_format", "{:.2%}".format):
+        print("\nAccuracy by model:")
+        print(accuracy_table(results, ["model", "size"]))
+        print("\nAccuracy by model and category:")
+        print(accuracy_table(results, ["model", "size", "category"]))
+        print("\nAccuracy by model and algorithm:")
+        print(accuracy_table(results, ["model", "size", "algorithm"]))
+    if save_path is not None:
+        results.to_csv(save_path, index=False)
+        print(f"\nSaved accuracy table to {save_path}")
+    print(f"Evaluation completed successfully!")
+
+
+def main_store(store_dir: Path = OUTPUT_STORE_DIR) -> None:
+    print(f"Evaluating every run in {store_dir}...")
+    results = evaluate_store(store_dir)
+    with pd.option_context("display.max_rows", None, "display.float_format", "{:.2%}".format):
+        print("\nAccuracy by run:")
+        print(accuracy_table(results, ["model", "size", "run_id"]))
+        print("\nAccuracy by run and category:")
+        print(accuracy_table(results, ["model", "size", "run_id", "category"]))
+    print(f"Evaluation completed successfully!")
 
 
 def main(model: str, size: int) -> None:
     print(f"Evaluating {model} with {size} prompts...")
     for method in ['base', 'cot', 'react', 'scope']:
-        accuracy = evaluate_bench(model, method, size)
-        print(f"{method} accuracy: {accuracy*100:.2f}% ({round(accuracy*size)}/{size} correct)")
+        num_correct, num_outputs = count_correct(model, method, size)
+        accuracy = num_correct / num_outputs if num_outputs else 0.0
+        failed = count_failures(output_file(OUTPUTS_DIR, model, method, size), current_prompt_ids(method, size))
+        print(f"{method} accuracy: {accuracy*100:.2f}% ({num_correct}/{num_outputs} correct, {failed} failed requests)")
     print(f"Evaluation completed successfully!")
 
 
@@ -0,0 +1,155 @@
+import asyncio
+import random
+import time
+from typing import Any, Awaitable, Callable
+import httpx
+import openai
+
+# Attempts made for a request before it is recorded as failed
+MAX_ATTEMPTS = 5
+
+# Backoff before retry n is drawn uniformly from [0, min(MAX_BACKOFF, BASE_BACKOFF * 2**n)]
+BASE_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+
+# A request is healthy while its latency per completion token stays within
+# this factor of the lowest seen; only then does the concurrency limit grow
+LATENCY_TOLERANCE = 2.0
+
+# Factor the concurrency limit is cut by on a 429 or a timeout
+DECREASE_FACTOR = 0.5
+
+def is_overload(error: Exception) -> bool:
+    """Errors that mean the server is taking more requests than it can serve."""
+    return isinstance(error, (openai.RateLimitError, openai.APITimeoutError, httpx.TimeoutException))
+
+
+def is_transient(error: Exception) -> bool:
+    """Errors worth retrying: overload, dropped connections and 5xx responses."""
+    return is_overload(error) or isinstance(
+        error, (openai.APIConnectionError, openai.InternalServerError, httpx.TransportError)
+    )
+
+
+def retry_after(error: Exception) -> float:
+    response = getattr(error, "response", None)
+    if response is None:
+        return 0.0
+    try:
+        return float(response.headers.get("retry-after", 0))
+    except ValueError:
+        # an HTTP date rather than a number of seconds
+        return 0.0
+
+
+def backoff_delay(attempt: int, error: Exception) -> float:
+    """
+    Exponential backoff with full jitter, so that requests failing together
+    do not retry together, but never sooner than the server's Retry-After.
+    """
+    delay = random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+    return max(delay, retry_after(error))
+
+
+def call_with_retries(request: Callable[[], Any], max_attempts: int = MAX_ATTEMPTS) -> tuple[Any, int]:
+    """
+    Call request() until it succeeds, backing off between attempts on
+    transient errors. Returns the result and the number of attempts made;
+    raises the last error on a permanent one or after max_attempts.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return request(), attempt + 1
+        except Exception as e:
+            if not is_transient(e) or attempt + 1 == max_attempts:
+                raise
+            time.sleep(backoff_delay(attempt, e))
+
+
+class AIMDLimiter:
+    """
+    Adaptive limit on the number of requests in flight. Starts in slow
+    start, growing the limit by one per healthy response, and after the
+    first overload grows it by one per limit's worth of healthy responses
+    (additive increase). A 429 or a timeout cuts the limit by
+    DECREASE_FACTOR (multiplicative decrease), at most once per round of
+    requests sent before the previous cut. Latency above LATENCY_TOLERANCE
+    times the best seen holds the limit where it is.
+    """
+    def __init__(self, initial_limit: int, min_limit: int = 1, max_limit: int | None = None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit if max_limit is not None else initial_limit
+        self.limit = float(min(max(initial_limit, min_limit), self.max_limit))
+        self.in_flight = 0
+        self.slow_start = True
+        self.best_latency = None
+        self.last_decrease = float("-inf")
+        self.decreases = 0
+        self.peak_limit = self.limit
+        self.condition = asyncio.Condition()
+
+    async def acquire(self) -> float:
+        """Wait for a free slot. Returns the time the request was let through."""
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, sent_at: float, latency: float | None = None, overloaded: bool = False) -> None:
+        """
+        Free the slot of a request sent at sent_at, adjusting the limit to
+        how it went: a healthy latency, an overload error, or neither.
+        """
+        async with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.decrease(sent_at)
+            elif latency is not None:
+                self.increase(latency)
+            self.condition.notify_all()
+
+    def increase(self, latency: float) -> None:
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        if latency > self.best_latency * LATENCY_TOLERANCE:
+            return
+        step = 1.0 if self.slow_start else 1.0 / self.limit
+        self.limit = min(self.max_limit, self.limit + step)
+        self.peak_limit = max(self.peak_limit, self.limit)
+
+    def decrease(self, sent_at: float) -> None:
+        if sent_at < self.last_decrease:
+            # sent before the last cut, so already accounted for by it
+            return
+        self.slow_start = False
+        self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+        self.last_decrease = time.monotonic()
+        self.decreases += 1
+
+    def stats(self) -> dict[str, float | int]:
+        return {"limit": self.limit, "peak_limit": self.peak_limit, "decreases": self.decreases}
+
+
+async def call_with_retries_async(
+    request: Callable[[], Awaitable[Any]],
+    limiter: AIMDLimiter,
+    latency_of: Callable[[Any], float | None] = lambda result: None,
+    max_attempts: int = MAX_ATTEMPTS,
+) -> tuple[Any, int]:
+    """
+    Async counterpart of call_with_retries that holds a limiter slot for
+    each attempt (but not while backing off) and feeds the limiter the
+    outcome: the latency latency_of(result) reports, or the overload.
+    """
+    for attempt in range(max_attempts):
+        sent_at = await limiter.acquire()
+        try:
+            result = await request()
+        except Exception as e:
+            await limiter.release(sent_at, overloaded=is_overload(e))
+            if not is_transient(e) or attempt + 1 == max_attempts:
+                raise
+            await asyncio.sleep(backoff_delay(attempt, e))
+            continue
+        await limiter.release(sent_at, latency=latency_of(result))
+        return result, attempt + 1
@@ -0,0 +1,94 @@
+from pathlib import Path
+import sys
+import pandas as pd
+
+# add project root to Python path to allow imports
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from scripts.output_records import iter_records, output_file
+
+MODEL_OUTPUTS_DIR = project_root / "model_outputs"
+
+# Per-request fields written by run_bench that the report reads
+METRIC_COLUMNS = ["endpoint", "latency", "ttft", "queue_time", "retries", "prompt_tokens", "cached_prompt_tokens", "completion_tokens", "started_at"]
+
+def load_request_metrics(model: str, size: int, outputs_dir: Path = MODEL_OUTPUTS_DIR, run_id: str | None = None) -> pd.DataFrame:
+    """
+    Collect the per-request metrics of every method's run into one frame.
+    Output files are appended to across runs, so only the records of run_id
+    are used, or without one those of the run that wrote each file's last
+    record. Cached responses and records written before requests were
+    instrumented have no latency and are left out, as they say nothing
+    about the endpoint.
+    """
+    rows = []
+    for method in ['base', 'cot', 'react', 'scope']:
+        path = output_file(outputs_dir, model, method, size)
+        if not path.exists():
+            continue
+        # (run id, row) of every instrumented record, until the file's last run is known
+        method_rows, last_run_id = [], None
+        for record in iter_records(path):
+            last_run_id = record.get("run_id")
+            if record.get("cached") or record.get("latency") is None:
+                continue
+            method_rows.append((last_run_id, {
+                "method": method,
+                "category": record["category"],
+                **{column: record.get(column) for column in METRIC_COLUMNS},
+            }))
+        wanted_run_id = run_id or last_run_id
+        rows += [row for record_run_id, row in method_rows if record_run_id == wanted_run_id]
+    return pd.DataFrame(rows, columns=["method", "category", *METRIC_COLUMNS])
+
+
+def summarize_requests(group: pd.DataFrame) -> pd.Series:
+    # wall clock from the first request sent to the last response received
+    elapsed = (group["started_at"] + group["latency"]).max() - group["started_at"].min()
+    completion_tokens = group["completion_tokens"].sum(min_count=1)
+    prompt_tokens = group["prompt_tokens"].sum(min_count=1)
+    cached_prompt_tokens = group["cached_prompt_tokens"].sum(min_count=1)
+    return pd.Series({
+        "requests": len(group),
+        "p50_latency": group["latency"].quantile(0.50),
+        "p95_latency": group["latency"].quantile(0.95),
+        "p99_latency": group["latency"].quantile(0.99),
+        "mean_ttft": group["ttft"].mean(),
+        "mean_queue_time": group["queue_time"].mean(),
+        "retries": group["retries"].sum(min_count=1),
+        "prompt_tokens": prompt_tokens,
+        # prefill the server skipped thanks to its prefix cache, when it reports it
+        "cached_prompt_tokens": cached_prompt_tokens,
+        "prefix_cache_share": cached_prompt_tokens / prompt_tokens if prompt_tokens > 0 else None,
+        "completion_tokens": completion_tokens,
+        "requests_per_s": len(group) / elapsed if elapsed > 0 else None,
+        "tokens_per_s": completion_tokens / elapsed if elapsed > 0 else None,
+    })
+
+
+def latency_table(metrics: pd.DataFrame, by: list[str]) -> pd.DataFrame:
+    return metrics.groupby(by).apply(summarize_requests, include_groups=False)
+
+
+def display_latency_report(model: str, size: int, outputs_dir: Path = MODEL_OUTPUTS_DIR, run_id: str | None = None) -> None:
+    metrics = load_request_metrics(model, size, outputs_dir, run_id)
+    if metrics.empty:
+        print("No instrumented requests to report on.")
+        return
+
+    with pd.option_context("display.float_format", "{:.3f}".format, "display.width", 200, "display.max_columns", None):
+        print()
+        print("######################")
+        print("### LATENCY REPORT ###")
+        print("######################")
+        print(latency_table(metrics, ["method"]))
+        print()
+        print(latency_table(metrics, ["method", "category"]))
+        if metrics["endpoint"].nunique() > 1:
+            print()
+            print(latency_table(metrics, ["endpoint"]))
+
+
+if __name__ == "__main__":
+    display_latency_report(model="tei", size=100)
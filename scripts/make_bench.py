@@ -1,106 +1,217 @@
-import json
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import multiprocessing
+import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pathlib import Path
 import random
 import re
 import sys
+import tempfile
 
 project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
-from scripts.prompt_templates import BASE_PROMPT, COT_PROMPT, REACT_PROMPT, SCOPE_PROMPT
+from scripts.prompt_templates import BASE_PROMPT, COT_PROMPT, REACT_PROMPT, SCOPE_PROMPT, SCOPE_PREFIX_FIRST_PROMPT
 from scripts.problem_mappings import ProblemType
+from scripts.schema_registry import read_algorithm_schema, read_example, read_schema
+from scripts.benchmark_store import CompactBenchmarkWriter, JsonBenchmarkWriter, encode_compact_rows, encode_json_rows, render_benchmark
 
 BENCH_DIR = project_root / "benchmark_datasets"
 SOURCE_DATASET = project_root / "source_datasets" / "processed_clrs_dataset.parquet"
 
-# Compile regex patterns to speed up regex matches, since we do a lot
-TRACE_PATTERN = re.compile(r"trace \| .*?")
+# Regex patterns are applied column-wise by pyarrow's compute kernels (RE2),
+# so they must stay within the syntax RE2 and Python's re have in common.
+# The trace marker used to be the pattern r"trace \| .*?", whose lazy tail
+# always matches nothing, so it is removed as a plain substring instead
+TRACE_MARKER = "trace | "
 INITIAL_TRACE_PATTERN = re.compile(r"initial_trace: \[.*\]\n")
 # ANSWER_PATTERN = re.compile(r"(?<= \| ).*")
 ANSWER_PATTERN = re.compile(r".*?\| ")
 
-def fetch_example_outputs(question_df: pd.DataFrame, algorithm: str) -> tuple[str, str]:
-    question_df = question_df[question_df['algorithm'] == algorithm]
-    random_indices = random.sample(list(range(len(question_df))), k=2)
-    example_output_A = question_df.iloc[random_indices[0]]['answer']
-    example_output_B = question_df.iloc[random_indices[1]]['answer']
-    return example_output_A, example_output_B
+# Default seed for drawing example outputs, so rebuilt benchmarks are identical
+DEFAULT_SEED = 0
+
+# SCOPE prompt layouts: "original" keeps the per-row fields at the top,
+# "prefix_first" puts the per-category schema and worked example first so
+# that servers with prefix caching reuse them across a category's prompts
+SCOPE_LAYOUTS = {
+    "original": SCOPE_PROMPT,
+    "prefix_first": SCOPE_PREFIX_FIRST_PROMPT,
+}
+DEFAULT_SCOPE_LAYOUT = "original"
+
+# Benchmark file formats: "compact" parquet rows rendered on load by
+# run_bench, or "json" with every prompt rendered in full
+BENCHMARK_FORMATS = ("compact", "json")
+DEFAULT_BENCHMARK_FORMAT = "compact"
+
+# Source rows read, processed and written at a time by the streaming build
+BUILD_CHUNK_SIZE = 4096
+
+# Columns of the source dataset the benchmarks are built from, as spooled
+# to disk once processed
+SPOOL_SCHEMA = pa.schema([
+    ("algorithm", pa.string()),
+    ("category", pa.string()),
+    ("question", pa.string()),
+    ("answer", pa.string()),
+])
+
+# Builds of at least this many rows spread their shards over a process pool
+PARALLEL_THRESHOLD = 20_000
+
+# Spools opened in this process, by path
+SPOOL_CACHE: dict[str, pa.Table] = {}
+
+def index_answers_by_algorithm(question_df: pd.DataFrame) -> dict[str, np.ndarray]:
+    """
+    Map each algorithm to the positions of its rows in question_df, so that
+    example outputs can be drawn without rescanning the whole frame.
+    """
+    return question_df.groupby('algorithm', sort=False).indices
+
+
+def draw_example_positions(algorithm_index: dict[str, np.ndarray], algorithm: str, rng: random.Random) -> tuple[int, int]:
+    # every method draws from a fresh RNG with the same seed, so a given
+    # row gets the same example outputs in every benchmark
+    positions = algorithm_index[algorithm]
+    random_indices = rng.sample(range(len(positions)), k=2)
+    return positions[random_indices[0]], positions[random_indices[1]]
+
+
+def fetch_example_outputs(answers: np.ndarray, algorithm_index: dict[str, np.ndarray], algorithm: str, rng: random.Random) -> tuple[str, str]:
+    position_A, position_B = draw_example_positions(algorithm_index, algorithm, rng)
+    return answers[position_A], answers[position_B]
+
+
+def to_arrow_strings(texts: pd.Series) -> pd.Series:
+    # arrow-backed strings route .str methods to vectorized pyarrow kernels
+    return texts.astype(pd.ArrowDtype(pa.string()))
+
+
+def trim_questions(questions: pd.Series) -> pd.Series:
+    # remove trace and initial trace from clrs dataset questions
+    trimmed_questions = (
+        to_arrow_strings(questions)
+        .str.replace(TRACE_MARKER, "", regex=False)
+        .str.replace(INITIAL_TRACE_PATTERN.pattern, "", regex=True)
+        .str.strip()
+    )
+    return trimmed_questions.astype(object)
+
+
+def extract_answers(answers: pd.Series) -> pd.Series:
+    trimmed_answers = (
+        to_arrow_strings(answers)
+        .str.replace(ANSWER_PATTERN.pattern, "", regex=True)
+        .str.strip()
+    )
+    return trimmed_answers.astype(object)
 
 
 def process_questions(question_df: pd.DataFrame) -> pd.DataFrame:
-    def trim_question(question: str) -> str:
-        # remove trace and initial trace from clrs dataset questions
-        trimmed_question = TRACE_PATTERN.sub("", question)
-        trimmed_question = INITIAL_TRACE_PATTERN.sub("", trimmed_question)
-        return trimmed_question.strip()
-    def extract_answer(answer: str) -> str:
-        trimmed_answer = ANSWER_PATTERN.sub("", answer)
-        return trimmed_answer.strip()
-    question_df['question'] = question_df['question'].map(trim_question)
-    question_df['answer'] = question_df['answer'].map(extract_answer)
+    question_df['question'] = trim_questions(question_df['question'])
+    question_df['answer'] = extract_answers(question_df['answer'])
     return question_df
 
 
-def make_non_scope_benchmark(method: str, question_df: pd.DataFrame, num_prompts: int) -> list[str]:
-    prompt_template = {
-        "cot": COT_PROMPT,
-        "react": REACT_PROMPT,
-        "base": BASE_PROMPT,
-    }[method]
+# Prompt template of each method other than SCOPE, whose template depends on the layout
+NON_SCOPE_TEMPLATES = {
+    "cot": COT_PROMPT,
+    "react": REACT_PROMPT,
+    "base": BASE_PROMPT,
+}
 
-    dataset = []
+def non_scope_row(row: pd.Series | dict, example_output_A: str, example_output_B: str) -> dict:
+    return {
+        "algorithm": row['algorithm'],
+        "category": row['category'],
+        "algorithm_name": row['algorithm'],
+        "question": row['question'],
+        "answer": row['answer'],
+        "example_output_A": example_output_A,
+        "example_output_B": example_output_B,
+        "schema_key": None,
+        "example_key": None,
+    }
+
+
+def make_non_scope_rows(question_df: pd.DataFrame, num_prompts: int, algorithm_index: dict[str, np.ndarray], seed: int = DEFAULT_SEED) -> list[dict]:
+    rng = random.Random(seed)
+    answers = question_df['answer'].to_numpy()
+    rows = []
     for i in range(min(len(question_df), num_prompts)):
         row = question_df.iloc[i]
-        example_output_A, example_output_B = fetch_example_outputs(question_df, row['algorithm'])
-        dataset.append({
-            "algorithm": row['algorithm'],
-            "category": row['category'],
-            "prompt": prompt_template.format(
-                algorithm_name=row['algorithm'],
-                question=row['question'],
-                example_output_A=example_output_A,
-                example_output_B=example_output_B,
-            ),
-            "question": row['question'],
-            "answer": row['answer']
-        })
-    return dataset
-
-
-def make_scope_benchmark(question_df: pd.DataFrame, num_prompts: int) -> list[str]:
-    def read_schema(category: str) -> Path:
-        schema_file = Path(__file__).parent.parent / "old_schemas" / f"{category}_schema.txt"
-        with open(schema_file, "r") as f:
-            return f.read()
-
-    def read_example(category: str) -> str:
-        example_file = Path(__file__).parent.parent / "old_schemas" / f"{category}_example.txt"
-        with open(example_file, "r") as f:
-            return f.read()
-    
-    dataset = []
+        rows.append(non_scope_row(row, *fetch_example_outputs(answers, algorithm_index, row['algorithm'], rng)))
+    return rows
+
+
+def make_non_scope_benchmark(method: str, question_df: pd.DataFrame, num_prompts: int, algorithm_index: dict[str, np.ndarray], seed: int = DEFAULT_SEED) -> list[dict]:
+    rows = make_non_scope_rows(question_df, num_prompts, algorithm_index, seed)
+    return render_benchmark(NON_SCOPE_TEMPLATES[method], rows)
+
+
+def scope_template(layout: str) -> str:
+    if layout not in SCOPE_LAYOUTS:
+        raise ValueError(f"Unknown SCOPE layout: {layout} (expected one of {', '.join(SCOPE_LAYOUTS)})")
+    return SCOPE_LAYOUTS[layout]
+
+
+def add_scope_texts(schemas: dict[str, str], examples: dict[str, str], category: str, algorithm: str, schema_variant: str | None = None, slice_schemas: bool = False) -> str:
+    """
+    Make sure the schema and worked example a SCOPE row of this category
+    and algorithm refers to are in schemas and examples, and return the
+    key of its schema. With slice_schemas, the schema is only the parts of
+    the category's schema that apply to the algorithm.
+    """
+    schema_key = f"{category}/{algorithm}" if slice_schemas else category
+    if schema_key not in schemas:
+        if slice_schemas:
+            schemas[schema_key] = read_algorithm_schema(category, algorithm, schema_variant)
+        else:
+            schemas[schema_key] = read_schema(category, schema_variant)
+    if category not in examples:
+        examples[category] = read_example(category, schema_variant)
+    return schema_key
+
+
+def scope_row(row: pd.Series | dict, i: int, example_output_A: str, example_output_B: str, schema_key: str) -> dict:
+    return {
+        "algorithm": row['algorithm'],
+        "category": row['category'],
+        "algorithm_name": f"Algorithm {i+1}",
+        "question": row['question'],
+        "answer": row['answer'],
+        "example_output_A": example_output_A,
+        "example_output_B": example_output_B,
+        "schema_key": schema_key,
+        "example_key": row['category'],
+    }
+
+
+def make_scope_rows(question_df: pd.DataFrame, num_prompts: int, algorithm_index: dict[str, np.ndarray], seed: int = DEFAULT_SEED, schema_variant: str | None = None, slice_schemas: bool = False) -> tuple[list[dict], dict[str, str], dict[str, str]]:
+    """SCOPE rows along with the schemas and worked examples they refer to by key."""
+    rng = random.Random(seed)
+    answers = question_df['answer'].to_numpy()
+    rows, schemas, examples = [], {}, {}
     for i in range(min(len(question_df), num_prompts)):
         row = question_df.iloc[i]
-        schema = read_schema(row['category'])
-        example = read_example(row['category'])
-        example_output_A, example_output_B = fetch_example_outputs(question_df, row['algorithm'])
-        dataset.append({
-            "algorithm": row['algorithm'],
-            "category": row['category'],
-            "prompt": SCOPE_PROMPT.format(
-                algorithm_name=f"Algorithm {i+1}",
-                question=row['question'],
-                example_output_A=example_output_A,
-                example_output_B=example_output_B,
-                worked_example=example,
-                algorithm_schema=schema,
-            ),
-            "question": row['question'],
-            "answer": row['answer']
-        })
-
-    return dataset
+        schema_key = add_scope_texts(schemas, examples, row['category'], row['algorithm'], schema_variant, slice_schemas)
+        example_outputs = fetch_example_outputs(answers, algorithm_index, row['algorithm'], rng)
+        rows.append(scope_row(row, i, *example_outputs, schema_key))
+    return rows, schemas, examples
+
+
+def make_scope_benchmark(question_df: pd.DataFrame, num_prompts: int, algorithm_index: dict[str, np.ndarray], seed: int = DEFAULT_SEED, schema_variant: str | None = None, layout: str = DEFAULT_SCOPE_LAYOUT, slice_schemas: bool = False) -> list[dict]:
+    """Render the SCOPE prompt of each row; see add_scope_texts for slice_schemas."""
+    template = scope_template(layout)
+    rows, schemas, examples = make_scope_rows(question_df, num_prompts, algorithm_index, seed, schema_variant, slice_schemas)
+    return render_benchmark(template, rows, schemas, examples)
 
 
 def ensure_dir(dir: Path) -> Path:
@@ -108,21 +219,186 @@ def ensure_dir(dir: Path) -> Path:
     return dir 
 
 
-def make_benchmarks(question_df: pd.DataFrame, num_prompts: int) -> list[str]:
+def method_template(method: str, scope_layout: str = DEFAULT_SCOPE_LAYOUT) -> str:
+    return scope_template(scope_layout) if method == 'scope' else NON_SCOPE_TEMPLATES[method]
+
+
+def open_benchmark_writer(method: str, num_prompts: int, benchmark_format: str, template: str, schemas: dict[str, str], examples: dict[str, str]) -> CompactBenchmarkWriter | JsonBenchmarkWriter:
+    """
+    Open the benchmark file of a method for writing. The compact format
+    stores each row's fields in parquet with the template, schemas and
+    worked examples once in the file metadata, and run_bench renders
+    prompts as it sends them; the json format stores every prompt fully
+    rendered. A benchmark file of the other format is removed.
+    """
+    if benchmark_format not in BENCHMARK_FORMATS:
+        raise ValueError(f"Unknown benchmark format: {benchmark_format} (expected one of {', '.join(BENCHMARK_FORMATS)})")
+    compact_file = ensure_dir(BENCH_DIR) / f"benchmark_{method}_{num_prompts}.parquet"
+    json_file = compact_file.with_suffix(".json")
+    # run_bench reads the parquet file whenever there is one, so a file of
+    # the other format left by an earlier build would shadow or outlive this one
+    if benchmark_format == "compact":
+        json_file.unlink(missing_ok=True)
+        return CompactBenchmarkWriter(compact_file, template, schemas, examples)
+    compact_file.unlink(missing_ok=True)
+    return JsonBenchmarkWriter(json_file, template, schemas, examples)
+
+
+def make_benchmarks(question_df: pd.DataFrame, num_prompts: int, seed: int = DEFAULT_SEED, schema_variant: str | None = None, scope_layout: str = DEFAULT_SCOPE_LAYOUT, slice_schemas: bool = False, benchmark_format: str = DEFAULT_BENCHMARK_FORMAT) -> None:
+    """Write every method's benchmark from a question frame held in memory."""
     question_df = process_questions(question_df)
+    algorithm_index = index_answers_by_algorithm(question_df)
     for method in ['cot', 'react', 'base', 'scope']:
         if method != 'scope':
-            dataset = make_non_scope_benchmark(method, question_df, num_prompts)
+            rows, schemas, examples = make_non_scope_rows(question_df, num_prompts, algorithm_index, seed), {}, {}
+        else:
+            rows, schemas, examples = make_scope_rows(question_df, num_prompts, algorithm_index, seed, schema_variant, slice_schemas)
+        with open_benchmark_writer(method, num_prompts, benchmark_format, method_template(method, scope_layout), schemas, examples) as writer:
+            writer.write(rows)
+
+
+def spool_questions(dataset_path: Path, spool_path: Path, chunk_size: int = BUILD_CHUNK_SIZE) -> dict[str, np.ndarray]:
+    """
+    Process the source dataset a record batch at a time into an Arrow IPC
+    file at spool_path, and return index_answers_by_algorithm of the whole
+    of it. Only one batch is held in memory at a time.
+    """
+    parquet_file = pq.ParquetFile(dataset_path)
+    positions, offset = defaultdict(list), 0
+    with pa.OSFile(str(spool_path), "wb") as sink, pa.ipc.new_file(sink, SPOOL_SCHEMA) as writer:
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=SPOOL_SCHEMA.names):
+            chunk = process_questions(batch.to_pandas())
+            writer.write_table(pa.Table.from_pandas(chunk, schema=SPOOL_SCHEMA, preserve_index=False))
+            for algorithm, indices in chunk.groupby('algorithm', sort=False).indices.items():
+                positions[algorithm].append(indices + offset)
+            offset += len(chunk)
+    return {algorithm: np.concatenate(indices) for algorithm, indices in positions.items()}
+
+
+def open_spool(spool_path: Path) -> pa.Table:
+    # memory-mapped, so rows are paged in from disk as they are read
+    # instead of being loaded into memory up front, and processes reading
+    # the same spool share its pages
+    return pa.ipc.open_file(pa.memory_map(str(spool_path), "r")).read_all()
+
+
+def retrieve_spool(spool_path: Path) -> pa.Table:
+    """Open the spool at spool_path once per process."""
+    if str(spool_path) not in SPOOL_CACHE:
+        SPOOL_CACHE[str(spool_path)] = open_spool(spool_path)
+    return SPOOL_CACHE[str(spool_path)]
+
+
+def collect_scope_texts(questions: pa.Table, num_rows: int, chunk_size: int, schema_variant: str | None = None, slice_schemas: bool = False) -> tuple[dict[str, str], dict[str, str]]:
+    """
+    The schemas and worked examples the first num_rows SCOPE rows refer
+    to, in the order make_scope_rows meets them, so that they can be
+    written to the benchmark's metadata before its rows.
+    """
+    schemas, examples = {}, {}
+    for start in range(0, num_rows, chunk_size):
+        chunk = questions.select(['category', 'algorithm']).slice(start, min(chunk_size, num_rows - start)).to_pandas()
+        for category, algorithm in chunk.drop_duplicates().itertuples(index=False):
+            add_scope_texts(schemas, examples, category, algorithm, schema_variant, slice_schemas)
+    return schemas, examples
+
+
+def draw_all_example_positions(questions: pa.Table, num_rows: int, algorithm_index: dict[str, np.ndarray], seed: int, chunk_size: int) -> np.ndarray:
+    """
+    Positions of the two example outputs of each of the first num_rows
+    rows, the same for every method. Drawing them up front lets shards of
+    rows be built independently.
+    """
+    rng = random.Random(seed)
+    positions = []
+    for start in range(0, num_rows, chunk_size):
+        algorithms = questions.column('algorithm').slice(start, min(chunk_size, num_rows - start)).to_pylist()
+        positions.extend(draw_example_positions(algorithm_index, algorithm, rng) for algorithm in algorithms)
+    return np.array(positions, dtype=np.int64).reshape(-1, 2)
+
+
+def build_shard(spool_path: Path, method: str, start: int, example_positions: np.ndarray, benchmark_format: str, scope_layout: str, schema_variant: str | None, slice_schemas: bool) -> pa.Table | list[str]:
+    """
+    Build rows start to start + len(example_positions) of a method's
+    benchmark from the spool, encoded for the method's benchmark writer.
+    Depends only on its arguments, so shards can be built in any process
+    and in any order.
+    """
+    questions = retrieve_spool(spool_path)
+    chunk = questions.slice(start, len(example_positions)).to_pylist()
+    example_answers = questions.column('answer').take(pa.array(example_positions.ravel())).to_pylist()
+    rows, schemas, examples = [], {}, {}
+    for j, row in enumerate(chunk):
+        example_output_A, example_output_B = example_answers[2 * j], example_answers[2 * j + 1]
+        if method == 'scope':
+            schema_key = add_scope_texts(schemas, examples, row['category'], row['algorithm'], schema_variant, slice_schemas)
+            rows.append(scope_row(row, start + j, example_output_A, example_output_B, schema_key))
         else:
-            dataset = make_scope_benchmark(question_df, num_prompts)
-        with open(ensure_dir(BENCH_DIR) / f"benchmark_{method}_{num_prompts}.json", "w") as f:
-            json.dump(dataset, f, indent=2)
+            rows.append(non_scope_row(row, example_output_A, example_output_B))
+    if benchmark_format == "compact":
+        return encode_compact_rows(rows)
+    return encode_json_rows(method_template(method, scope_layout), rows, schemas, examples)
+
+
+def make_benchmarks_streaming(dataset_path: Path, num_prompts: int, seed: int = DEFAULT_SEED, schema_variant: str | None = None, scope_layout: str = DEFAULT_SCOPE_LAYOUT, slice_schemas: bool = False, benchmark_format: str = DEFAULT_BENCHMARK_FORMAT, chunk_size: int = BUILD_CHUNK_SIZE, num_workers: int | None = None) -> None:
+    """
+    Same benchmarks as make_benchmarks, built out of core: the source is
+    processed in record batches into a memory-mapped spool file, then every
+    method's rows are built in shards of chunk_size rows and appended to
+    its file in order, so memory use does not grow with the dataset.
+    Builds of at least PARALLEL_THRESHOLD rows spread the shards of all
+    methods over num_workers processes (defaults to the cpu count), which
+    map the same spool; the files are byte-identical to a serial build.
+    """
+    with tempfile.TemporaryDirectory() as spool_dir:
+        spool_path = Path(spool_dir) / "questions.arrow"
+        algorithm_index = spool_questions(dataset_path, spool_path, chunk_size)
+        try:
+            questions = retrieve_spool(spool_path)
+            num_rows = min(questions.num_rows, num_prompts)
+            schemas, examples = collect_scope_texts(questions, num_rows, chunk_size, schema_variant, slice_schemas)
+            example_positions = draw_all_example_positions(questions, num_rows, algorithm_index, seed, chunk_size)
+
+            methods = ['cot', 'react', 'base', 'scope']
+            shards = [(method, start) for start in range(0, num_rows, chunk_size) for method in methods]
+            shard_args = (
+                [spool_path] * len(shards),
+                [method for method, _ in shards],
+                [start for _, start in shards],
+                [example_positions[start:start + chunk_size] for _, start in shards],
+                [benchmark_format] * len(shards),
+                [scope_layout] * len(shards),
+                [schema_variant] * len(shards),
+                [slice_schemas] * len(shards),
+            )
+            num_workers = num_workers or os.cpu_count() or 1
+            with contextlib.ExitStack() as stack:
+                writers = {
+                    method: stack.enter_context(open_benchmark_writer(
+                        method, num_prompts, benchmark_format, method_template(method, scope_layout),
+                        schemas if method == 'scope' else {}, examples if method == 'scope' else {},
+                    ))
+                    for method in methods
+                }
+                if num_rows < PARALLEL_THRESHOLD or num_workers == 1:
+                    encoded_shards = map(build_shard, *shard_args)
+                else:
+                    # spawn rather than fork, so that workers do not inherit
+                    # the parent's pyarrow thread pools mid-use
+                    mp_context = multiprocessing.get_context("spawn")
+                    pool = stack.enter_context(ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context))
+                    encoded_shards = pool.map(build_shard, *shard_args)
+                # results come back in submission order, so every file gets its shards in row order
+                for (method, _), encoded in zip(shards, encoded_shards):
+                    writers[method].write_encoded(encoded)
+        finally:
+            # release the mapping so the spool file can be removed
+            SPOOL_CACHE.pop(str(spool_path), None)
 
 
-def main(dataset_path: Path = SOURCE_DATASET, num_prompts: int = 100):
+def main(dataset_path: Path = SOURCE_DATASET, num_prompts: int = 100, seed: int = DEFAULT_SEED, schema_variant: str | None = None, scope_layout: str = DEFAULT_SCOPE_LAYOUT, slice_schemas: bool = False, benchmark_format: str = DEFAULT_BENCHMARK_FORMAT, num_workers: int | None = None):
     print("Making benchmarks...")
-    question_df = pd.read_parquet(dataset_path)
-    make_benchmarks(question_df, num_prompts)
+    make_benchmarks_streaming(dataset_path, num_prompts, seed, schema_variant, scope_layout, slice_schemas, benchmark_format, num_workers=num_workers)
     print("Benchmarks made successfully!")
 
 
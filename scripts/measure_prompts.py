@@ -3,10 +3,7 @@ import os
 import sys
 import pandas as pd
 import json
-import re
 from collections import defaultdict
-from transformers import AutoTokenizer
-from typing import Any
 
 # add project root to Python path to allow imports
 project_root = Path(__file__).parent.parent
@@ -15,51 +12,17 @@ sys.path.insert(0, str(project_root))
 from scripts.problem_mappings import ProblemType, PROBLEM_TYPES, PROBLEM_MAPPING
 from scripts.prepare_clrs_dataset import prepare_clrs_dataset
 from scripts.prompt_templates import BASE_PROMPT, COT_PROMPT, REACT_PROMPT, SCOPE_PROMPT
+from scripts.schema_registry import read_algorithm_schema, read_full, read_schema, schema_files
+from scripts.make_bench import SCOPE_LAYOUTS, index_answers_by_algorithm, make_scope_benchmark, process_questions, trim_questions
+from scripts.token_counter import DEFAULT_MODEL_ID, count_tokens
 
-# Default tokenizer is GPT-2 BPE tokenizer
-DEFAULT_MODEL_ID = "gpt2"
 
-# Cache used tokenizers in memory for quick retrieval
-TOKENIZER_CACHE: dict[str, Any] = {}
-
-def retrieve_tokenizer(model_id: str) -> Any:
-    """
-    Search for loaded tokenizer in cache.
-    If not present, load the tokenizer for
-    model_id from huggingface.
-    """
-    if model_id in TOKENIZER_CACHE:
-        return TOKENIZER_CACHE[model_id]
-    tokenizer = AutoTokenizer.from_pretrained(model_id) 
-    TOKENIZER_CACHE[model_id] = tokenizer
-    return tokenizer
-
-
-def compute_token_count(text: str, model_id: str = "gpt2") -> int:
-    """
-    Compute the number of tokens in the given text using the tokenizer
-    for model_id.
-    """
-    # get tokenizer for model_id
-    tokenizer = retrieve_tokenizer(model_id)
-
-    # encode prompt, output and useful output
-    encoded_text = tokenizer.encode(text, add_special_tokens=True)
-
-    return len(encoded_text)
-
-
-def display_schema_token_counts(model_id: str, schema_dir: Path) -> None:
+def display_schema_token_counts(model_id: str, schema_variant: str | None = None) -> None:
+    files = schema_files(schema_variant)
+    schema_strs = [read_full(schema_file) for _, _, schema_file in files]
     token_counts = defaultdict(int)
-    for schema_file in os.listdir(schema_dir):
-        if re.match(r".*_(schema|example)\.txt", schema_file) is None:
-            # not a schema/example file
-            continue
-        with open(schema_dir / schema_file, "r") as f:
-            schema_str = f.read()
-        # extract problem category
-        problem_category = re.match(r"(\w*)_(schema|example)\.txt", schema_file).group(1)
-        token_counts[problem_category] += compute_token_count(schema_str, model_id)
+    for (problem_category, _, _), count in zip(files, count_tokens(schema_strs, model_id)):
+        token_counts[problem_category] += count
 
     # pretty print schema token counts per problem category
     print()
@@ -71,24 +34,43 @@ def display_schema_token_counts(model_id: str, schema_dir: Path) -> None:
     print(f"Average: {average_token_length} tokens")
 
 
+def compute_schema_slice_token_counts(model_id: str, schema_variant: str | None = None) -> pd.DataFrame:
+    """
+    Token counts of the whole category schema and of the slice for each
+    algorithm, with the reduction slicing gives.
+    """
+    algorithms = sorted(PROBLEM_MAPPING.items(), key=lambda item: (item[1], item[0]))
+    full_schemas = [read_schema(category, schema_variant) for _, category in algorithms]
+    sliced_schemas = [read_algorithm_schema(category, algorithm, schema_variant) for algorithm, category in algorithms]
+    counts = pd.DataFrame({
+        "category": [category for _, category in algorithms],
+        "full_tokens": count_tokens(full_schemas, model_id),
+        "sliced_tokens": count_tokens(sliced_schemas, model_id),
+    }, index=pd.Index([algorithm for algorithm, _ in algorithms], name="algorithm"))
+    counts["reduction"] = 1 - counts["sliced_tokens"] / counts["full_tokens"]
+    return counts
+
+
+def display_schema_slice_token_counts(model_id: str, schema_variant: str | None = None) -> None:
+    counts = compute_schema_slice_token_counts(model_id, schema_variant)
+    print()
+    print("##########################################")
+    print("### SCHEMA TOKEN LENGTHS PER ALGORITHM ###")
+    print("##########################################")
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200, "display.float_format", "{:.1%}".format):
+        print(counts)
+    saved = (counts["full_tokens"] - counts["sliced_tokens"]).mean()
+    print(f"Average: {saved:.2f} schema tokens saved per SCOPE prompt when slicing ({counts['reduction'].mean():.1%})")
+
+
 def compute_avg_question_token_counts(df: pd.DataFrame) -> int:
-    def trim_question(question: str) -> str:
-        cleaned_question = re.sub(r"trace \| .*?", "", question)
-        cleaned_question = re.sub(r"initial_trace: \[.*\]\n", "", cleaned_question)
-        return cleaned_question.strip()
-    return round(sum((map(
-        lambda q: compute_token_count(q, DEFAULT_MODEL_ID),
-        df['question'].map(trim_question)
-    ))) / len(df), 2)
+    return round(sum(count_tokens(trim_questions(df['question']).tolist(), DEFAULT_MODEL_ID)) / len(df), 2)
 
 
 def compute_template_token_counts() -> dict[str, int]:
     return dict(zip(
         ["base", "cot", "react", "scope"],
-        map(
-            compute_token_count,
-            [BASE_PROMPT, COT_PROMPT, REACT_PROMPT, SCOPE_PROMPT]
-        )
+        count_tokens([BASE_PROMPT, COT_PROMPT, REACT_PROMPT, SCOPE_PROMPT])
     ))
 
 
@@ -100,10 +82,11 @@ def display_template_token_counts() -> None:
     print(json.dumps(compute_template_token_counts(), indent=2))
 
 
-def display_avg_question_token_counts(dataset_file: Path) -> None:
+def display_avg_question_token_counts(dataset_file: Path, offline: bool = False) -> None:
     if not os.path.exists(dataset_file):
+        print(f"\nNo processed dataset at {dataset_file}, preparing one (from the dataset cache if already built)...")
         fetch_counts = dict([(category, 100) for category in PROBLEM_TYPES])
-        prepare_clrs_dataset(fetch_counts, sum(fetch_counts.values()))
+        prepare_clrs_dataset(fetch_counts, sum(fetch_counts.values()), offline=offline)
 
     df = pd.read_parquet(dataset_file)
 
@@ -115,13 +98,49 @@ def display_avg_question_token_counts(dataset_file: Path) -> None:
     print()
 
 
-def main() -> None:
+def estimate_prefix_reuse(prompts: list[str], model_id: str = DEFAULT_MODEL_ID) -> tuple[int, int]:
+    """
+    Estimate how much prefill a server with prefix caching skips when the
+    prompts are sent in the given order: the tokens of the prefix each
+    prompt shares with the one before it. Returns (reusable, total) tokens.
+    """
+    shared_prefixes = [""] + [os.path.commonprefix([previous, prompt]) for previous, prompt in zip(prompts, prompts[1:])]
+    reusable = sum(count_tokens(shared_prefixes, model_id))
+    total = sum(count_tokens(prompts, model_id))
+    return reusable, total
+
+
+def display_prefix_reuse(dataset_file: Path, num_prompts: int = 100, model_id: str = DEFAULT_MODEL_ID) -> None:
+    df = pd.read_parquet(dataset_file)
+    question_df = process_questions(df)
+    algorithm_index = index_answers_by_algorithm(question_df)
+
+    print()
+    print("###############################################")
+    print("### SCOPE PREFILL TOKENS REUSABLE BY LAYOUT ###")
+    print("###############################################")
+    reusable_by_layout = {}
+    for layout in SCOPE_LAYOUTS:
+        dataset = make_scope_benchmark(question_df, num_prompts, algorithm_index, layout=layout)
+        # in run_bench's dispatch order: grouped by category, benchmark order within
+        prompts = [item["prompt"] for item in sorted(dataset, key=lambda item: item["category"])]
+        reusable, total = estimate_prefix_reuse(prompts, model_id)
+        reusable_by_layout[layout] = reusable
+        print(f"{layout}: {reusable}/{total} prompt tokens reusable ({reusable / total:.1%}), {total - reusable} to prefill")
+    baseline = reusable_by_layout["original"]
+    for layout, reusable in reusable_by_layout.items():
+        if layout != "original":
+            print(f"{layout} saves {reusable - baseline} prefill tokens over original ({(reusable - baseline) / len(prompts):.1f} per prompt)")
+
+
+def main(offline: bool = False) -> None:
     model_id = DEFAULT_MODEL_ID
-    schema_dir = project_root / "old_schemas"
     dataset_file = project_root / "source_datasets" / "processed_clrs_dataset.parquet"
-    display_schema_token_counts(model_id, schema_dir)
+    display_schema_token_counts(model_id)
+    display_schema_slice_token_counts(model_id)
     display_template_token_counts()
-    display_avg_question_token_counts(dataset_file)
+    display_avg_question_token_counts(dataset_file, offline)
+    display_prefix_reuse(dataset_file, model_id=model_id)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,333 @@
+from pathlib import Path
+import sys
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 20000
+
+# Distributions the time to first token is drawn from, each parameterized by its mean
+LATENCY_DISTRIBUTIONS = ("constant", "uniform", "exponential", "lognormal")
+
+# Canned completion: some reasoning, the answer, then trailing text that
+# clients cutting the stream at the closing answer tag never wait for
+CANNED_REASONING = "Let me work through the algorithm step by step and track its state."
+CANNED_ANSWER = "<answer> 0 </answer>"
+CANNED_TRAILER = "That completes the trace of the algorithm on the given input."
+
+class MockHTTPServer(ThreadingHTTPServer):
+    # a load test opens many connections at once; the default backlog of 5
+    # drops connection attempts, which then stall for a second-long SYN retry
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class MockServer:
+    """
+    Offline stand-in for an OpenAI-compatible /v1/chat/completions
+    endpoint. Serves the canned completion with a time to first token
+    drawn from `latency_dist` (mean `latency` seconds) plus `token_delay`
+    seconds per generated token, streams it when asked to, honors stop
+    sequences and injects 429 and 500 responses at the given rates. Like a
+    server with prefix caching, it reports the words a prompt shares with
+    the one before it as cached prompt tokens.
+    """
+    def __init__(
+        self,
+        host: str = DEFAULT_HOST,
+        port: int = DEFAULT_PORT,
+        latency: float = 0.05,
+        latency_dist: str = "constant",
+        token_delay: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int | None = 0,
+    ):
+        if latency_dist not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {latency_dist}")
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.token_delay = token_delay
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "rate_limited": 0, "errors": 0}
+        self.last_prompt = []
+
+        handler = type("MockHandler", (MockHandler,), {"mock": self})
+        self.httpd = MockHTTPServer((host, port), handler)
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def sample_latency(self) -> float:
+        with self.lock:
+            if self.latency_dist == "uniform":
+                return self.rng.uniform(0, 2 * self.latency)
+            if self.latency_dist == "exponential":
+                return self.rng.expovariate(1 / self.latency) if self.latency > 0 else 0.0
+            if self.latency_dist == "lognormal":
+                # sigma 1 gives a heavy tail; mu is chosen so the mean stays at `latency`
+                return self.rng.lognormvariate(math.log(self.latency) - 0.5, 1.0) if self.latency > 0 else 0.0
+            return self.latency
+
+    def draw_status(self) -> int:
+        """Decide whether the next request succeeds or gets an injected error."""
+        with self.lock:
+            self.counts["requests"] += 1
+            roll = self.rng.random()
+            if roll < self.rate_limit_rate:
+                self.counts["rate_limited"] += 1
+                return 429
+            if roll < self.rate_limit_rate + self.error_rate:
+                self.counts["errors"] += 1
+                return 500
+            return 200
+
+    def cached_prefix(self, prompt: list[str]) -> int:
+        """Length of the prefix prompt shares with the previous prompt, which is then replaced by it."""
+        with self.lock:
+            shared = shared_prefix(self.last_prompt, prompt)
+            self.last_prompt = prompt
+            return shared
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.counts)
+
+    def start(self) -> "MockServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "MockServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+def completion_tokens(stop: list[str] | None) -> list[str]:
+    """Split the canned completion into word tokens, ending before the first stop sequence."""
+    text = f"{CANNED_REASONING} {CANNED_ANSWER} {CANNED_TRAILER}"
+    stop_positions = [text.find(sequence) for sequence in stop or [] if sequence in text]
+    if stop_positions:
+        text = text[:min(stop_positions)]
+    words = text.split(" ")
+    return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+
+def shared_prefix(previous: list[str], prompt: list[str]) -> int:
+    shared = 0
+    for previous_word, word in zip(previous, prompt):
+        if previous_word != word:
+            break
+        shared += 1
+    return shared
+
+
+def prompt_words(body: dict) -> list[str]:
+    return [word for message in body.get("messages", []) for word in message["content"].split()]
+
+
+def canned_completion(body: dict, cached_tokens: int) -> tuple[list[str], str, dict]:
+    """
+    Tokens, finish reason and usage of the canned completion for a chat
+    completions request body, honoring its stop sequences and max_tokens.
+    """
+    stop = body.get("stop")
+    tokens = completion_tokens([stop] if isinstance(stop, str) else stop)
+    max_tokens = body.get("max_tokens") or len(tokens)
+    finish_reason = "length" if len(tokens) > max_tokens else "stop"
+    tokens = tokens[:max_tokens]
+    usage = {
+        "prompt_tokens": len(prompt_words(body)),
+        "completion_tokens": len(tokens),
+        "prompt_tokens_details": {"cached_tokens": cached_tokens},
+    }
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    return tokens, finish_reason, usage
+
+
+def chat_completion(model: str, tokens: list[str], finish_reason: str, usage: dict) -> dict:
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "finish_reason": finish_reason,
+            "message": {"role": "assistant", "content": "".join(tokens)},
+        }],
+        "usage": usage,
+    }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    mock: MockServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def send_json(self, status: int, body: dict, headers: dict | None = None) -> None:
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "not_found"}})
+            return
+
+        status = self.mock.draw_status()
+        if status == 429:
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}}, {"Retry-After": "0"})
+            return
+        if status == 500:
+            self.send_json(500, {"error": {"message": "Injected server error", "type": "server_error"}})
+            return
+
+        tokens, finish_reason, usage = canned_completion(body, self.mock.cached_prefix(prompt_words(body)))
+
+        time.sleep(self.mock.sample_latency())
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+            self.stream_completion(body["model"], tokens, finish_reason, usage if include_usage else None)
+            return
+
+        time.sleep(self.mock.token_delay * len(tokens))
+        self.send_json(200, chat_completion(body["model"], tokens, finish_reason, usage))
+
+    def stream_completion(self, model: str, tokens: list[str], finish_reason: str, usage: dict | None) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def chunk(delta: dict, finish: str | None = None, chunk_usage: dict | None = None, choices: bool = True) -> bytes:
+            event = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}] if choices else [],
+            }
+            if chunk_usage is not None:
+                event["usage"] = chunk_usage
+            return f"data: {json.dumps(event)}\n\n".encode("utf-8")
+
+        try:
+            self.wfile.write(chunk({"role": "assistant", "content": ""}))
+            for token in tokens:
+                time.sleep(self.mock.token_delay)
+                self.wfile.write(chunk({"content": token}))
+                self.wfile.flush()
+            self.wfile.write(chunk({}, finish_reason))
+            if usage is not None:
+                self.wfile.write(chunk({}, chunk_usage=usage, choices=False))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client closed the stream early, e.g. once the answer was complete
+            pass
+
+
+def process_batch(input_file: Path, output_file: Path, error_rate: float = 0.0, seed: int | None = 0) -> dict[str, int]:
+    """
+    Offline stand-in for the Batch API: answer each line of a batch input
+    file with the canned completion and write a batch output file in the
+    format the Batch API returns, failing `error_rate` of the requests with
+    a 500. Prompts are processed in file order, so like a server with prefix
+    caching it reports the words a prompt shares with the one before it as
+    cached prompt tokens.
+    """
+    rng = random.Random(seed)
+    counts = {"requests": 0, "errors": 0}
+    last_prompt = []
+    with open(input_file, "r") as f_in, open(output_file, "w") as f_out:
+        for i, line in enumerate(f_in):
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            counts["requests"] += 1
+            if rng.random() < error_rate:
+                counts["errors"] += 1
+                status, response_body = 500, {"error": {"message": "Injected server error", "type": "server_error"}}
+            else:
+                body = request["body"]
+                prompt = prompt_words(body)
+                tokens, finish_reason, usage = canned_completion(body, shared_prefix(last_prompt, prompt))
+                last_prompt = prompt
+                status, response_body = 200, chat_completion(body["model"], tokens, finish_reason, usage)
+            f_out.write(json.dumps({
+                "id": f"batch_req_mock_{i}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": status, "request_id": f"req_mock_{i}", "body": response_body},
+                "error": None,
+            }) + "\n")
+    return counts
+
+
+def print_usage() -> None:
+    print(
+"""Usage: python mock_server.py [options]
+Arguments:
+  --port | -p <port> - Port to listen on (defaults to 20000)
+  --latency | -l <seconds> - Mean time to first token (defaults to 0.05)
+  --latency-dist | -d <dist> - One of constant, uniform, exponential, lognormal (defaults to constant)
+  --token-delay | -t <seconds> - Time per generated token (defaults to 0)
+  --rate-limit-rate <fraction> - Fraction of requests answered with 429 (defaults to 0)
+  --error-rate <fraction> - Fraction of requests answered with 500 (defaults to 0)
+Example usage: python mock_server.py --port 20000 --latency 0.5 --latency-dist lognormal --rate-limit-rate 0.05"""
+    )
+
+
+def parse_args() -> dict:
+    args = sys.argv[1:]
+    options = {
+        "--port": ("port", int), "-p": ("port", int),
+        "--latency": ("latency", float), "-l": ("latency", float),
+        "--latency-dist": ("latency_dist", str), "-d": ("latency_dist", str),
+        "--token-delay": ("token_delay", float), "-t": ("token_delay", float),
+        "--rate-limit-rate": ("rate_limit_rate", float),
+        "--error-rate": ("error_rate", float),
+    }
+    config = {}
+    for i in range(0, len(args), 2):
+        if args[i] not in options or i + 1 >= len(args):
+            print(f"Error: Invalid argument: {args[i]}\n")
+            print_usage()
+            sys.exit(1)
+        key, convert = options[args[i]]
+        config[key] = convert(args[i+1])
+    return config
+
+
+if __name__ == "__main__":
+    server = MockServer(**parse_args())
+    print(f"Mock server listening on {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
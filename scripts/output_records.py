@@ -0,0 +1,139 @@
+from pathlib import Path
+import os
+import json
+from typing import Collection, Iterator, TextIO
+
+def output_file(outputs_dir: Path, model: str, method: str, size: int) -> Path:
+    """
+    Return the model output file for a (model, method, size) run. Prefer
+    the append-only JSONL file written by run_bench, falling back to a
+    legacy JSON array file if only that exists.
+    """
+    jsonl_file = outputs_dir / f"{model}_{method}_{size}.jsonl"
+    legacy_file = jsonl_file.with_suffix(".json")
+    if not jsonl_file.exists() and legacy_file.exists():
+        return legacy_file
+    return jsonl_file
+
+
+# Number of characters read at a time when streaming a JSON array
+READ_CHUNK_SIZE = 1 << 20
+
+def iter_json_array(f: TextIO) -> Iterator[dict]:
+    """
+    Yield the elements of a top-level JSON array one at a time, holding
+    only the current element and one read chunk in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos = "", 0
+    started = False
+    eof = False
+    while True:
+        # skip whitespace and separators between elements
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,[":
+            if buffer[pos] == "[":
+                if started:
+                    break
+                started = True
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        if pos < len(buffer) and started:
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+                # an element ending exactly at the buffer end may be cut short
+                if end < len(buffer) or eof:
+                    yield element
+                    pos = end
+                    continue
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+        if eof:
+            return
+        chunk = f.read(READ_CHUNK_SIZE)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def iter_records(path: Path | str) -> Iterator[dict]:
+    """
+    Yield output records one at a time. JSONL files are streamed line by
+    line and legacy JSON array files element by element. A truncated last
+    JSONL line (e.g. from a run killed mid-write) is skipped.
+    """
+    path = Path(path)
+    if path.suffix == ".json":
+        with open(path, "r") as f:
+            yield from iter_json_array(f)
+        return
+
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def is_failure(record: dict) -> bool:
+    """Whether a record holds a request that failed rather than a model output."""
+    return "error" in record
+
+
+def completed_ids(path: Path | str) -> set[str]:
+    """
+    IDs of the prompts with a model output. Failed requests do not count,
+    so they are retried when the run is resumed and their successful
+    record is appended after the failed one.
+    """
+    if not Path(path).exists():
+        return set()
+    return {record["id"] for record in iter_records(path) if "id" in record and not is_failure(record)}
+
+
+def iter_outputs(path: Path | str, prompt_ids: Collection[str] | None = None) -> Iterator[dict]:
+    """
+    Yield the records of an output file that hold a model output, skipping
+    failed requests and, given the prompt ids of the current benchmark,
+    records left by earlier builds of it.
+    """
+    return (
+        record for record in iter_records(path)
+        if not is_failure(record) and (prompt_ids is None or record.get("id") in prompt_ids)
+    )
+
+
+def count_failures(path: Path | str, prompt_ids: Collection[str] | None = None) -> int:
+    """Number of prompts whose request failed and has not succeeded since, among prompt_ids if given."""
+    failed, succeeded = set(), set()
+    for record in iter_records(path):
+        if prompt_ids is not None and record.get("id") not in prompt_ids:
+            continue
+        (failed if is_failure(record) else succeeded).add(record.get("id"))
+    return len(failed - succeeded)
+
+
+def open_for_append(path: Path) -> TextIO:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # terminate a partial line left by an interrupted write so the next
+    # record starts on its own line
+    needs_newline = False
+    if path.exists() and path.stat().st_size > 0:
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+    f = open(path, "a")
+    if needs_newline:
+        f.write("\n")
+    return f
+
+
+def append_record(f: TextIO, record: dict) -> None:
+    # flush after every record so a crash loses at most the one in flight
+    f.write(json.dumps(record) + "\n")
+    f.flush()
@@ -0,0 +1,144 @@
+from pathlib import Path
+import sys
+import time
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# add project root to Python path to allow imports
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from scripts.output_records import iter_records, output_file
+
+MODEL_OUTPUTS_DIR = project_root / "model_outputs"
+OUTPUT_STORE_DIR = project_root / "output_store"
+
+# Columns the runs are partitioned by, as model=.../method=.../size=.../run_id=... directories
+PARTITION_SCHEMA = pa.schema([
+    ("model", pa.string()),
+    ("method", pa.string()),
+    ("size", pa.int32()),
+    ("run_id", pa.string()),
+])
+
+# Typed columns of an output record. Fields a record lacks, such as the
+# metrics of a cached response or the stream statistics of a run that
+# did not stream, are null
+RECORD_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("algorithm", pa.string()),
+    ("category", pa.string()),
+    ("question", pa.string()),
+    ("answer", pa.string()),
+    ("model_output", pa.string()),
+    ("error", pa.string()),
+    ("cached", pa.bool_()),
+    ("endpoint", pa.string()),
+    ("started_at", pa.float64()),
+    ("latency", pa.float64()),
+    ("ttft", pa.float64()),
+    ("queue_time", pa.float64()),
+    ("retries", pa.int32()),
+    ("prompt_tokens", pa.int64()),
+    ("cached_prompt_tokens", pa.int64()),
+    ("completion_tokens", pa.int64()),
+    ("streamed_tokens", pa.int64()),
+    ("stopped_at_answer", pa.bool_()),
+    ("budget_remaining", pa.int64()),
+    ("batch_request_id", pa.string()),
+])
+
+# Number of records converted to Arrow at a time when storing a run
+STORE_BATCH_SIZE = 4096
+
+def new_run_id() -> str:
+    return time.strftime("%Y%m%dT%H%M%S")
+
+
+def records_by_run(path: Path) -> dict[str | None, list[dict]]:
+    """
+    The last record of every prompt in an output file, grouped by the id
+    of the run that wrote it, so that a request that failed and succeeded
+    later in the same run is stored once, as a success. Records written
+    before runs had ids are grouped under None.
+    """
+    runs = {}
+    for record in iter_records(path):
+        latest = runs.setdefault(record.get("run_id"), {})
+        latest.pop(record.get("id"), None)
+        latest[record.get("id")] = record
+    return {run_id: list(latest.values()) for run_id, latest in runs.items()}
+
+
+def record_batches(records: list[dict], partition: dict) -> list[pa.RecordBatch]:
+    schema = pa.unify_schemas([RECORD_SCHEMA, PARTITION_SCHEMA])
+    batches = []
+    for start in range(0, len(records), STORE_BATCH_SIZE):
+        rows = [
+            {**{column: record.get(column) for column in RECORD_SCHEMA.names}, **partition}
+            for record in records[start:start + STORE_BATCH_SIZE]
+        ]
+        batches.append(pa.RecordBatch.from_pylist(rows, schema=schema))
+    return batches
+
+
+def write_partition(records: list[dict], partition: dict, store_dir: Path = OUTPUT_STORE_DIR) -> None:
+    batches = record_batches(records, partition)
+    if not batches:
+        return
+    ds.write_dataset(
+        batches,
+        store_dir,
+        schema=batches[0].schema,
+        format="parquet",
+        partitioning=ds.partitioning(PARTITION_SCHEMA, flavor="hive"),
+        existing_data_behavior="delete_matching",
+    )
+
+
+def store_run(model: str, method: str, size: int, run_id: str, outputs_dir: Path = MODEL_OUTPUTS_DIR, store_dir: Path = OUTPUT_STORE_DIR) -> None:
+    """
+    Copy the records run run_id wrote to the output file of a (model,
+    method, size) run into the parquet store under its
+    model=/method=/size=/run_id= partition, replacing what a previous
+    store of the same run id wrote there. Records of other runs appended
+    to the same file are left out.
+    """
+    records = records_by_run(output_file(outputs_dir, model, method, size)).get(run_id, [])
+    partition = {"model": model, "method": method, "size": size, "run_id": run_id}
+    write_partition(records, partition, store_dir)
+
+
+def open_store(store_dir: Path = OUTPUT_STORE_DIR) -> ds.Dataset:
+    return ds.dataset(store_dir, format="parquet", partitioning=ds.partitioning(PARTITION_SCHEMA, flavor="hive"))
+
+
+def load_outputs(store_dir: Path = OUTPUT_STORE_DIR, columns: list[str] | None = None, filter: ds.Expression | None = None) -> pa.Table:
+    """
+    Scan the stored runs into one table, reading only the given columns
+    and the partitions and row groups the filter can match, e.g.
+    load_outputs(columns=["method", "latency"], filter=ds.field("model") == "tei").
+    """
+    return open_store(store_dir).to_table(columns=columns, filter=filter)
+
+
+def main(outputs_dir: Path = MODEL_OUTPUTS_DIR, store_dir: Path = OUTPUT_STORE_DIR) -> None:
+    """
+    Store every output file under outputs_dir, one partition per run that
+    wrote to it. Records written before runs had ids are stored as one
+    run, with a new timestamp as its id.
+    """
+    # imported here as eval_bench imports this module
+    from scripts.eval_bench import discover_output_files
+
+    backfill_run_id = new_run_id()
+    runs = discover_output_files(outputs_dir)
+    for model, method, size, path in runs:
+        for run_id, records in records_by_run(path).items():
+            partition = {"model": model, "method": method, "size": size, "run_id": run_id or backfill_run_id}
+            write_partition(records, partition, store_dir)
+    print(f"Stored {len(runs)} output files under {store_dir} (records without a run id as run {backfill_run_id})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,16 @@
 from dataclasses import dataclass
 from huggingface_hub import snapshot_download
+from huggingface_hub.errors import LocalEntryNotFoundError
 import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 from pathlib import Path
-import random
 import sys
 from types import MappingProxyType
+from typing import Iterator
 import json
 
 # add project root to Python path to allow imports
@@ -13,17 +18,32 @@ project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
 from scripts.problem_mappings import ProblemType, PROBLEM_MAPPING, PROBLEM_TYPES
+from scripts.stratified_sampler import DEFAULT_SEED, ReservoirSampler, allocate_quotas
+from scripts.dataset_cache import (
+    dataset_cache_key,
+    dataset_params,
+    find_cached_dataset,
+    load_cached_dataset,
+    shard_checksum,
+    store_cached_dataset,
+)
 
 CLRS_TEXT_TRAIN_REPO = 'tomg-group-umd/CLRS-Text-train'
 SAVE_DIR = project_root / "source_datasets"
 
-def download_hf_dataset(hf_repo_id: str) -> str:
-    return snapshot_download(repo_id=hf_repo_id, repo_type='dataset', allow_patterns='*.parquet')
+# Only these columns of the CLRS-Text shards are used downstream
+LOADED_COLUMNS = ["question", "answer", "algo_name"]
+
+def download_hf_dataset(hf_repo_id: str, offline: bool = False) -> str:
+    # in offline mode only the local huggingface cache is used, never the network
+    return snapshot_download(repo_id=hf_repo_id, repo_type='dataset', allow_patterns='*.parquet', local_files_only=offline)
 
 
 def get_parquet_filepaths(root: str) -> list[Path]:
     data_path = Path(root) / 'data'
-    contents = os.listdir(data_path)
+    # sort so that shards are always scanned in the same order, which
+    # seeded sampling relies on to be reproducible
+    contents = sorted(os.listdir(data_path))
     return [
         data_path / entry
         for entry in contents
@@ -31,35 +51,76 @@ def get_parquet_filepaths(root: str) -> list[Path]:
     ]
 
 
-def parse_files_to_df(files: list[Path]) -> pd.DataFrame:
-    assert all(f.lower().endswith('.parquet') for f in map(str, files)), "Must be a .parquet file!"
+def wanted_algorithms(fetch_counts: dict[ProblemType, int]) -> dict[ProblemType, list[str]]:
+    """
+    Group the algorithms in PROBLEM_MAPPING by problem type, keeping only
+    problem types that have a non-zero fetch count.
+    """
+    algorithms = {}
+    for algo_name, pt in PROBLEM_MAPPING.items():
+        if fetch_counts.get(pt, 0) > 0:
+            algorithms.setdefault(pt, []).append(algo_name)
+    return algorithms
 
-    frames = [pd.read_parquet(f) for f in files]
-    return pd.concat(frames, ignore_index=True, sort=False)
 
+def scan_batches(files: list[Path], fetch_counts: dict[ProblemType, int]) -> Iterator[pa.RecordBatch]:
+    """
+    Scan the parquet shards in record batches, reading only LOADED_COLUMNS
+    and pushing the algo_name filter for the wanted algorithms down to the
+    scanner.
+    """
+    assert all(f.lower().endswith('.parquet') for f in map(str, files)), "Must be a .parquet file!"
+
+    algorithms = sum(wanted_algorithms(fetch_counts).values(), [])
+    if not algorithms:
+        return iter(())
 
-def filter_df(df: pd.DataFrame, fetch_counts: dict[ProblemType, int]) -> pd.DataFrame:
-    def filter_ptype(pt: ProblemType) -> pd.DataFrame:
-        ptype_df = df[df["category"] == pt]
-        return ptype_df.reset_index(drop=True).loc[:fetch_counts.get(pt, 0)]
-    split_frames = list(map(filter_ptype, PROBLEM_TYPES))
-    filtered_df = pd.concat(split_frames, ignore_index=True)
-    return filtered_df
+    dataset = ds.dataset([str(f) for f in files], format="parquet")
+    scanner = dataset.scanner(columns=LOADED_COLUMNS, filter=ds.field("algo_name").isin(algorithms))
+    return scanner.to_batches()
 
 
-def trim_df(df: pd.DataFrame, num_rows: int) -> pd.DataFrame:
-    if len(df) <= num_rows:
-        # no need to trim
-        return df
+def scan_files_to_df(files: list[Path], fetch_counts: dict[ProblemType, int]) -> pd.DataFrame:
+    """
+    Keep the first fetch_counts.get(pt, 0) rows of each problem type pt in
+    scan order and stop scanning as soon as every quota is met, so memory
+    scales with the number of rows kept rather than the size of the dataset.
+    """
+    value_sets = {pt: pa.array(algos) for pt, algos in wanted_algorithms(fetch_counts).items()}
+    remaining = {pt: fetch_counts[pt] for pt in value_sets}
+
+    kept_batches = []
+    for batch in scan_batches(files, fetch_counts):
+        kept_indices = []
+        for pt, value_set in value_sets.items():
+            if remaining[pt] <= 0:
+                continue
+            mask = pc.is_in(batch.column("algo_name"), value_set=value_set)
+            indices = np.flatnonzero(mask.to_numpy(zero_copy_only=False))[:remaining[pt]]
+            remaining[pt] -= len(indices)
+            kept_indices.append(indices)
+        if kept_indices:
+            # keep rows in scan order across problem types
+            kept_batches.append(batch.take(pa.array(np.sort(np.concatenate(kept_indices)))))
+        if all(count <= 0 for count in remaining.values()):
+            break
 
-    # fetch up to num_rows random rows from full_frame
-    random_indices = random.sample(range(len(df)), k=min(num_rows, len(df)))
-    truncated_frame = df.loc[random_indices]
+    if not kept_batches:
+        return pd.DataFrame(columns=LOADED_COLUMNS)
+    return pa.Table.from_batches(kept_batches).to_pandas()
 
-    # reset indices so that they are consecutive
-    truncated_frame.reset_index(inplace=True, drop=True) 
 
-    return truncated_frame
+def sample_files_to_df(files: list[Path], fetch_counts: dict[ProblemType, int], num_rows: int, seed: int) -> pd.DataFrame:
+    """
+    Draw a seeded stratified sample of up to fetch_counts.get(pt, 0) rows
+    per problem type pt (scaled down to num_rows in total) while streaming
+    over every shard. Only the sample and one record batch are held in
+    memory at a time.
+    """
+    sampler = ReservoirSampler(fetch_counts, by="category", num_rows=num_rows, seed=seed)
+    for batch in scan_batches(files, fetch_counts):
+        sampler.add(map_problem_types(batch.to_pandas()))
+    return sampler.result()
 
 
 def map_problem_types(df: pd.DataFrame) -> pd.DataFrame:
@@ -74,17 +135,63 @@ def ensure_save_path(save_path: Path) -> Path:
     return save_path
 
 
-def prepare_clrs_dataset(fetch_counts: dict[ProblemType, int], num_rows: int) -> pd.DataFrame:
+def process_clrs_files(parquet_files: list[Path], fetch_counts: dict[ProblemType, int], num_rows: int, seed: int | None) -> pd.DataFrame:
+    if seed is None:
+        quotas = allocate_quotas(fetch_counts, num_rows)
+        return map_problem_types(scan_files_to_df(parquet_files, quotas))
+    return sample_files_to_df(parquet_files, fetch_counts, num_rows, seed)
+
+
+def load_or_process_clrs_dataset(fetch_counts: dict[ProblemType, int], num_rows: int, seed: int | None, offline: bool) -> pd.DataFrame:
+    """
+    Return the processed dataset from the local dataset cache if one was
+    already built from the same source shards and parameters, otherwise
+    process the shards and cache the result. The network is only used when
+    there is neither a local snapshot nor a cached dataset to fall back on.
+    """
+    params = dataset_params(fetch_counts, num_rows, seed)
+    try:
+        # a local snapshot is used as is, without asking the hub for updates
+        snapshot_dir = download_hf_dataset(CLRS_TEXT_TRAIN_REPO, offline=True)
+    except LocalEntryNotFoundError:
+        # without a local snapshot, match the cache on parameters before downloading
+        cached_df = find_cached_dataset(params)
+        if cached_df is not None:
+            print("Using cached processed dataset (no local snapshot of the source shards)")
+            return cached_df
+        if offline:
+            raise RuntimeError(
+                f"Offline mode: no local snapshot of {CLRS_TEXT_TRAIN_REPO} and no cached "
+                "dataset for these parameters. Run once with network access first."
+            )
+        snapshot_dir = download_hf_dataset(CLRS_TEXT_TRAIN_REPO)
+    parquet_files = get_parquet_filepaths(snapshot_dir)
+
+    shards = {path.name: shard_checksum(path) for path in parquet_files}
+    key = dataset_cache_key(shards, params)
+    cached_df = load_cached_dataset(key)
+    if cached_df is not None:
+        print(f"Using cached processed dataset {key[:12]}")
+        return cached_df
+
+    prepared_df = process_clrs_files(parquet_files, fetch_counts, num_rows, seed)
+    store_cached_dataset(key, prepared_df, shards, params)
+    return prepared_df
+
+
+def prepare_clrs_dataset(fetch_counts: dict[ProblemType, int], num_rows: int, seed: int | None = DEFAULT_SEED, offline: bool = False) -> pd.DataFrame:
     """
     Fetch and process CLRS-Text dataset by mapping 30 original
     problem types ('algo_name' column) according to PROBLEM_MAPPING
-    and keep up to `num_rows` rows. Fetches as many of each problem type
-    pt without exceeding {fetch_counts.get(pt, 0)}. Return pandas 
-    dataframe for resulting processed dataset.
+    and keep up to `num_rows` rows. Samples up to fetch_counts.get(pt, 0)
+    rows of each problem type pt at random, scaling the counts down
+    proportionally if they add up to more than num_rows. With seed=None
+    the first rows of each problem type are kept instead, which stops
+    reading shards as soon as every count is met. Processed datasets are
+    cached locally, and offline=True never touches the network. Return
+    pandas dataframe for resulting processed dataset.
     """
-    parquet_files = get_parquet_filepaths(download_hf_dataset(CLRS_TEXT_TRAIN_REPO))
-    mapped_df = map_problem_types(parse_files_to_df(parquet_files))
-    prepared_df = trim_df(filter_df(mapped_df, fetch_counts), num_rows)
+    prepared_df = load_or_process_clrs_dataset(fetch_counts, num_rows, seed, offline)
 
     prepared_df.to_parquet(ensure_save_path(SAVE_DIR / "processed_clrs_dataset.parquet"))
 
@@ -93,7 +200,7 @@ def prepare_clrs_dataset(fetch_counts: dict[ProblemType, int], num_rows: int) ->
 
 def print_usage() -> None:
     usage = """
-python3 prepare_clrs_dataset.py --num-rows | -n <num_rows> [--fetch-counts-path | -f <fetch_path>]
+python3 prepare_clrs_dataset.py --num-rows | -n <num_rows> [--fetch-counts-path | -f <fetch_path>] [--seed | -s <seed>] [--offline]
 
     Arguments:
     --num-rows | -n <num_rows> - Maximum number of examples to fetch from the dataset.
@@ -110,6 +217,9 @@ python3 prepare_clrs_dataset.py --num-rows | -n <num_rows> [--fetch-counts-path
         "search": <num_examples>,
     },
     where <num_examples> is the maximum number of examples to fetch for each problem type.
+    --seed | -s <seed> - Seed for sampling examples at random (defaults to 0). Pass "none" to keep the
+    first examples of each problem type instead.
+    --offline - Never touch the network; use only the local huggingface and processed dataset caches.
 
     NOTE: If no fetch counts file is provided, we will default to fetching {num_rows // len(PROBLEM_TYPES)} examples
     for each problem type.
@@ -138,8 +248,14 @@ def parse_args(reqs: tuple[str, ...] = ("num_rows",)) -> dict[str, int | Path |
         }
         return {**defaults, **config}
     
-    for i in range(0, len(args), 2):
-        if args[i] in ("--num-rows", "-n"):
+    i = 0
+    while i < len(args):
+        if args[i] == "--offline":
+            # flag without a value
+            config["offline"] = True
+            i += 1
+            continue
+        elif args[i] in ("--num-rows", "-n"):
             config["num_rows"] = int(args[i+1])
         elif args[i] in ("--fetch-counts-path", "-f"):
             fetch_counts_path = Path(args[i+1]).resolve().with_suffix('.json')
@@ -149,12 +265,12 @@ def parse_args(reqs: tuple[str, ...] = ("num_rows",)) -> dict[str, int | Path |
             except: 
                 print(f"Error: Invalid fetch counts file: {args[i+1]}")
                 sys.exit(1)
+        elif args[i] in ("--seed", "-s"):
+            config["seed"] = None if args[i+1].lower() == "none" else int(args[i+1])
         else:
             print(f"Error: Invalid argument: {args[i]}")
             sys.exit(1)
-
-        if finished_parsing():
-            break
+        i += 2
 
     if not finished_parsing():
         print(f"Error: Missing required arguments: {', '.join(set(reqs) - set(config.keys()))}")
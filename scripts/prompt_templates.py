@@ -189,3 +189,34 @@ question: {question}
 
 """
 
+
+# Same content as SCOPE_PROMPT, laid out for servers with prefix (KV) caching:
+# everything shared by a category's prompts comes first and the per-row
+# fields last, so consecutive prompts of a category share a long prefix
+SCOPE_PREFIX_FIRST_PROMPT = """
+
+You are a helpful math assistant adept at solving math problems.
+
+You **should use the schema** below to guide your reasoning, but you can adapt it if necessary.
+Your reasoning will **not** be scored — only the final answer in the tags counts.
+
+worked_example: {worked_example}
+
+algorithm_schema: {algorithm_schema}
+
+Instructions for reasoning and final answer:
+1. You should follow the algorithm_schema when reasoning and performing intermediate steps, but adapt as needed for the problem.
+2. Show your reasoning freely in text above the final answer — include any calculations, checks, or sub-steps.
+3. After reasoning, output **only the final answer** in the exact form of example_output_A or example_output_B.
+4. The final answer must be enclosed exactly in `<answer>...</answer>` tags.
+5. Place the `<answer>` line on a new line at the very end of your response.
+6. Do not include any reasoning, calculations, or extra text inside the `<answer>` tags.
+
+
+This is your question to solve
+algorithm_name: {algorithm_name}
+example_output_A: {example_output_A}
+example_output_B: {example_output_B}
+question: {question}
+
+"""
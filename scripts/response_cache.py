@@ -0,0 +1,101 @@
+from pathlib import Path
+import hashlib
+import json
+import sqlite3
+import time
+
+project_root = Path(__file__).parent.parent
+
+CACHE_FILE = project_root / ".cache" / "responses.sqlite"
+
+# Upper bound on the total size of cached completions, in bytes
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# "use" reads and writes the cache, "refresh" skips reads but overwrites
+# stored completions with fresh ones, "bypass" leaves the cache untouched
+CACHE_MODES = ("use", "refresh", "bypass")
+
+def cache_key(model: str, base_url: str, messages: list[dict], temperature: float, max_tokens: int, stop: list[str] | None = None) -> str:
+    key_fields = [model, base_url, messages, temperature, max_tokens]
+    if stop is not None:
+        # only part of the key when set, so keys of requests without stop sequences are unchanged
+        key_fields.append(stop)
+    payload = json.dumps(key_fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    On-disk SQLite cache of chat completions. Entries are evicted least
+    recently used first once the stored completions exceed `max_bytes`.
+    """
+    def __init__(self, path: Path = CACHE_FILE, max_bytes: int = DEFAULT_MAX_BYTES, mode: str = "use"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Invalid cache mode: {mode} (expected one of {', '.join(CACHE_MODES)})")
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                output TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> str | None:
+        if self.mode != "use":
+            return None
+        row = self.conn.execute("SELECT output FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return row[0]
+
+    def put(self, key: str, output: str) -> None:
+        if self.mode == "bypass":
+            return
+        size = len(output.encode("utf-8"))
+        old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, output, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, output, size, time.time()),
+        )
+        self.total_bytes += size - (old[0] if old else 0)
+        self.evict()
+        self.conn.commit()
+
+    def evict(self) -> None:
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_used LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            evicted = []
+            for key, size in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                evicted.append((key,))
+                self.total_bytes -= size
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self) -> dict[str, int]:
+        entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": self.total_bytes}
+
+    def close(self) -> None:
+        self.conn.close()
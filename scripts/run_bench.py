@@ -1,65 +1,368 @@
 from pathlib import Path
 import sys
-import json
-from openai import OpenAI
+import asyncio
+import time
+from openai import OpenAI, AsyncOpenAI
 
 project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
 from scripts.problem_mappings import ProblemType
+from scripts.benchmark_store import prompt_id, read_benchmark, render_prompt
+from scripts.output_records import append_record, completed_ids, is_failure, open_for_append
+from scripts.response_cache import ResponseCache, cache_key
+from scripts.answer_stream import ANSWER_END_TAG, AnswerStreamReader, cached_prompt_tokens
+from scripts.endpoint_pool import EndpointPool
+from scripts.flow_control import AIMDLimiter, call_with_retries, call_with_retries_async
+from scripts.latency_report import display_latency_report
+from scripts.output_store import new_run_id, store_run
 
 BENCH_DIR = project_root / "benchmark_datasets"
 MODEL_OUTPUTS_DIR = project_root / "model_outputs"
 
-def run_benchmark(client: OpenAI, model: str, method: str, size: int):
-    with open(BENCH_DIR / f"benchmark_{method}_{size}.json", "r") as f:
-        benchmark_dataset = json.load(f)
+SYSTEM_PROMPT = "You are a helpful math assistant."
 
-    results = []
-    for idx, item in enumerate(benchmark_dataset):
-        print(f"Prompt {idx+1}:")
-        messages = [
-            {"role": "system", "content": "You are a helpful math assistant."},
-            {"role": "user", "content": item["prompt"]}
-        ]
+# Maximum number of requests in flight at once in async mode
+DEFAULT_CONCURRENCY = 16
+
+def load_benchmark(method: str, size: int) -> list[dict]:
+    return read_benchmark(BENCH_DIR, method, size)
+
+
+def build_messages(item: dict) -> list[dict]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": render_prompt(item)}
+    ]
+
+
+def completion_kwargs(model: str, messages: list[dict], stream: bool = False) -> dict:
+    kwargs = dict(
+        model=model,
+        messages=messages,
+        temperature=0.0,
+        max_tokens=8000,
+        tools=[],
+        tool_choice="none",
+    )
+    if stream:
+        # the stop sequence lets servers that honor it end generation themselves;
+        # AnswerStreamReader cuts the stream client-side for those that do not
+        kwargs.update(stream=True, stop=[ANSWER_END_TAG], stream_options={"include_usage": True})
+    return kwargs
+
+
+def request_cache_key(client: OpenAI | EndpointPool, kwargs: dict) -> str:
+    return cache_key(
+        model=kwargs["model"],
+        base_url=str(client.base_url),
+        messages=kwargs["messages"],
+        temperature=kwargs["temperature"],
+        max_tokens=kwargs["max_tokens"],
+        stop=kwargs.get("stop"),
+    )
+
+
+def usage_metrics(usage) -> dict:
+    return {
+        "prompt_tokens": usage.prompt_tokens if usage is not None else None,
+        "completion_tokens": usage.completion_tokens if usage is not None else None,
+        "cached_prompt_tokens": cached_prompt_tokens(usage),
+        "ttft": None,
+    }
+
+
+def request_output(client: OpenAI, kwargs: dict) -> tuple[str, dict]:
+    """
+    Call the v1/chat/completions endpoint and return the model output
+    along with its metrics: token usage, latency and, for streamed
+    requests, time to first token. Streamed
+    requests are closed as soon as the answer is complete.
+    """
+    started_at, start = time.time(), time.perf_counter()
+    raw_response = client.chat.completions.with_raw_response.create(**kwargs)
+    if not kwargs.get("stream"):
+        response = raw_response.parse()
+        model_output, metrics = response.choices[0].message.content, usage_metrics(response.usage)
+    else:
+        reader = AnswerStreamReader(kwargs["max_tokens"])
+        stream = raw_response.parse()
+        try:
+            for chunk in stream:
+                if reader.feed(chunk):
+                    break
+        finally:
+            stream.close()
+        model_output, metrics = reader.result()
+
+    metrics.update(started_at=started_at, latency=time.perf_counter() - start)
+    return model_output, metrics
+
+
+async def request_output_async(client: AsyncOpenAI, kwargs: dict) -> tuple[str, dict]:
+    started_at, start = time.time(), time.perf_counter()
+    raw_response = await client.chat.completions.with_raw_response.create(**kwargs)
+    if not kwargs.get("stream"):
+        response = raw_response.parse()
+        model_output, metrics = response.choices[0].message.content, usage_metrics(response.usage)
+    else:
+        reader = AnswerStreamReader(kwargs["max_tokens"])
+        stream = raw_response.parse()
         try:
-            # Call the v1/chat/completions endpoint
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.0,
-                max_tokens=8000,
-                tools=[],
-                tool_choice="none",
-            )
-            # Extract model output
-            model_output = response.choices[0].message.content
-        except Exception as e:
-            print(f"Error running prompt {idx+1}: {e}")
-            model_output = "<answer> response failed </answer>"
-        
-        print(f"{model_output}\n")
-
-        results.append({
-            "algorithm": item["algorithm"],
-            "category": item["category"],
-            "question": item["question"],
-            "answer": item["answer"],
-            "model_output": model_output
-        })
-
-    with open(MODEL_OUTPUTS_DIR / f"{model}_{method}_{size}.json", "w") as f:
-        json.dump(results, f, indent=2)
-
-
-def main(model: str, size: int, base_url: str, api_key: str):
-    client = OpenAI(base_url=base_url, api_key=api_key)
+            async for chunk in stream:
+                if reader.feed(chunk):
+                    break
+        finally:
+            await stream.close()
+        model_output, metrics = reader.result()
+
+    metrics.update(started_at=started_at, latency=time.perf_counter() - start)
+    return model_output, metrics
+
+
+def limiter_latency(result: tuple[str, dict]) -> float:
+    # normalize by output length, which varies far more between prompts
+    # than the server's speed does between healthy and overloaded
+    _, metrics = result
+    return metrics["latency"] / max(metrics["completion_tokens"] or 1, 1)
+
+
+def make_result(pid: str, item: dict, model_output: str | None, metrics: dict | None = None, run_id: str | None = None) -> dict:
+    return {
+        "id": pid,
+        # the invocation that wrote the record, as output files are appended to across runs
+        "run_id": run_id,
+        "algorithm": item["algorithm"],
+        "category": item["category"],
+        "question": item["question"],
+        "answer": item["answer"],
+        "model_output": model_output,
+        **(metrics or {}),
+    }
+
+
+def print_stream_stats(results: list[dict]) -> None:
+    streamed = [result for result in results if result.get("ttft") is not None]
+    if not streamed:
+        return
+    mean_ttft = sum(result["ttft"] for result in streamed) / len(streamed)
+    stopped = sum(1 for result in streamed if result["stopped_at_answer"])
+    budget_remaining = sum(result["budget_remaining"] for result in streamed)
+    print(
+        f"Streaming: mean TTFT {mean_ttft:.3f}s, {stopped}/{len(streamed)} requests cut at {ANSWER_END_TAG}, "
+        f"leaving {budget_remaining} tokens of their max_tokens budget unused"
+    )
+
+
+def print_failure_stats(results: list[dict]) -> None:
+    failed = sum(1 for result in results if is_failure(result))
+    if failed:
+        print(f"{failed}/{len(results)} requests failed after retries; run the benchmark again to retry them")
+
+
+def print_run_outcome(results: list[dict]) -> None:
+    """Report how the run went, exiting with status 1 if any request failed."""
+    failed = sum(1 for result in results if is_failure(result))
+    if failed:
+        print(f"\nBenchmark finished with {failed}/{len(results)} failed requests; run it again to retry them")
+        sys.exit(1)
+    print(f"\nBenchmark completed successfully!")
+
+
+def output_path(model: str, method: str, size: int, outputs_dir: Path = MODEL_OUTPUTS_DIR) -> Path:
+    return outputs_dir / f"{model}_{method}_{size}.jsonl"
+
+
+def pending_prompts(model: str, method: str, size: int, outputs_dir: Path = MODEL_OUTPUTS_DIR) -> list[tuple[int, str, dict]]:
+    """
+    Return (index, prompt id, item) for every benchmark prompt that does not
+    yet have a result in the output file, so that a restarted run picks up
+    where the previous one stopped. Prompts are grouped by category, which
+    is the order they are dispatched in: prompts of a category share their
+    schema and worked example, so servers with prefix caching can reuse them.
+    """
+    benchmark_dataset = load_benchmark(method, size)
+    done = completed_ids(output_path(model, method, size, outputs_dir))
+    pending = [
+        (idx, pid, item)
+        for idx, item in enumerate(benchmark_dataset)
+        if (pid := prompt_id(idx, item)) not in done
+    ]
+    # stable, so prompts keep their benchmark order within a category
+    pending.sort(key=lambda entry: entry[2]["category"])
+    if len(pending) < len(benchmark_dataset):
+        print(f"Resuming: {len(benchmark_dataset) - len(pending)} prompts already have results")
+    return pending
+
+
+def run_benchmark(client: OpenAI, model: str, method: str, size: int, cache: ResponseCache | None = None, stream: bool = False, outputs_dir: Path = MODEL_OUTPUTS_DIR, run_id: str | None = None) -> list[dict]:
+    run_id = run_id or new_run_id()
+    pending = pending_prompts(model, method, size, outputs_dir)
+
+    results = []
+    with open_for_append(output_path(model, method, size, outputs_dir)) as f:
+        for idx, pid, item in pending:
+            print(f"Prompt {idx+1}:")
+            kwargs = completion_kwargs(model, build_messages(item), stream)
+            key = request_cache_key(client, kwargs)
+            model_output = cache.get(key) if cache is not None else None
+            metrics = {"cached": model_output is not None}
+            if model_output is None:
+                try:
+                    (model_output, request_metrics), attempts = call_with_retries(lambda: request_output(client, kwargs))
+                    metrics.update(request_metrics, retries=attempts - 1)
+                    if cache is not None:
+                        cache.put(key, model_output)
+                except Exception as e:
+                    print(f"Error running prompt {idx+1}: {e}")
+                    metrics["error"] = f"{type(e).__name__}: {e}"
+
+            if model_output is not None:
+                print(f"{model_output}\n")
+
+            result = make_result(pid, item, model_output, metrics, run_id)
+            append_record(f, result)
+            results.append(result)
+
+    print_stream_stats(results)
+    print_failure_stats(results)
+    return results
+
+
+async def run_benchmark_async(pool: EndpointPool, model: str, method: str, size: int, concurrency: int = DEFAULT_CONCURRENCY, cache: ResponseCache | None = None, stream: bool = False, outputs_dir: Path = MODEL_OUTPUTS_DIR, limiter: AIMDLimiter | None = None, run_id: str | None = None) -> list[dict]:
+    """
+    Same as run_benchmark, but keeps several requests in flight at once,
+    spread over the endpoints of the pool. How many is up to the limiter,
+    which by default starts at a quarter of `concurrency` and adapts to
+    the server's latency and 429s without going over it. Records are
+    appended as responses arrive, so the file is in completion order;
+    prompt ids sort back into benchmark order.
+    """
+    run_id = run_id or new_run_id()
+    pending = pending_prompts(model, method, size, outputs_dir)
+    if limiter is None:
+        limiter = AIMDLimiter(max(1, concurrency // 4), max_limit=concurrency)
+
+    with open_for_append(output_path(model, method, size, outputs_dir)) as f:
+        async def run_prompt(idx: int, pid: str, item: dict) -> dict:
+            kwargs = completion_kwargs(model, build_messages(item), stream)
+            key = request_cache_key(pool, kwargs)
+            model_output = cache.get(key) if cache is not None else None
+            metrics = {"cached": model_output is not None}
+            if model_output is None:
+                queued_at = time.time()
+                try:
+                    ((model_output, request_metrics), endpoint), attempts = await call_with_retries_async(
+                        lambda: pool.run(lambda client: request_output_async(client, kwargs)),
+                        limiter,
+                        latency_of=lambda result: limiter_latency(result[0]),
+                    )
+                    # waiting for a slot, and for earlier attempts and their backoff
+                    queue_time = request_metrics["started_at"] - queued_at
+                    metrics.update(request_metrics, endpoint=endpoint, retries=attempts - 1, queue_time=queue_time)
+                    if cache is not None:
+                        cache.put(key, model_output)
+                except Exception as e:
+                    print(f"Error running prompt {idx+1}: {e}")
+                    metrics["error"] = f"{type(e).__name__}: {e}"
+
+            if model_output is not None:
+                print(f"Prompt {idx+1}:\n{model_output}\n")
+            result = make_result(pid, item, model_output, metrics, run_id)
+            append_record(f, result)
+            return result
+
+        # a fixed set of workers takes pending prompts one at a time, so that
+        # prompts are rendered when they are dispatched and at most
+        # `concurrency` of them are held rendered at once
+        results = [None] * len(pending)
+        queue = iter(enumerate(pending))
+        async def worker() -> None:
+            for position, (idx, pid, item) in queue:
+                results[position] = await run_prompt(idx, pid, item)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    print_stream_stats(results)
+    print_failure_stats(results)
+    return results
+
+
+def print_cache_stats(cache: ResponseCache) -> None:
+    stats = cache.stats()
+    print(f"Response cache: {stats['hits']} hits, {stats['misses']} misses ({stats['entries']} entries stored)")
+
+
+def print_limiter_stats(limiter: AIMDLimiter) -> None:
+    stats = limiter.stats()
+    print(f"Concurrency: ended at {stats['limit']:.1f}, peaked at {stats['peak_limit']:.1f}, cut {stats['decreases']} times on overload")
+
+
+def print_endpoint_stats(pool: EndpointPool) -> None:
+    if len(pool) == 1:
+        return
+    for stats in pool.stats():
+        print(f"Endpoint {stats['endpoint']}: {stats['served']} served, {stats['failed']} failed, drained {stats['drains']} times")
+
+
+async def main_async(model: str, size: int, base_urls: list[str], api_key: str, concurrency: int = DEFAULT_CONCURRENCY, cache_mode: str = "use", stream: bool = False, run_id: str | None = None):
+    run_id = run_id or new_run_id()
+    cache = ResponseCache(mode=cache_mode)
+    async with EndpointPool(base_urls, api_key, concurrency) as pool:
+        total_concurrency = concurrency * len(pool)
+        # shared by every method, so later methods start from what the earlier ones learned
+        limiter = AIMDLimiter(max(1, total_concurrency // 4), max_limit=total_concurrency)
+        print(f"Running benchmark for {model} with {size} prompts (up to {total_concurrency} concurrent requests over {len(pool)} endpoints)...\n")
+        results = []
+        for method in ['base', 'cot', 'react', 'scope']:
+            print(f"Running {method} method...")
+            results += await run_benchmark_async(pool=pool, size=size, model=model, method=method, concurrency=total_concurrency, cache=cache, stream=stream, limiter=limiter, run_id=run_id)
+            store_run(model, method, size, run_id)
+        print_endpoint_stats(pool)
+        print_limiter_stats(limiter)
+    print_cache_stats(cache)
+    cache.close()
+    display_latency_report(model, size, MODEL_OUTPUTS_DIR, run_id)
+    print_run_outcome(results)
+
+
+def main(model: str, size: int, base_url: str | list[str], api_key: str, concurrency: int = 1, cache_mode: str = "use", stream: bool = False, run_id: str | None = None):
+    """
+    Run every method's benchmark against the endpoint at base_url. Given
+    a list of base urls, prompts are spread over those replicas with up
+    to `concurrency` requests in flight per replica, and failing replicas
+    are drained while the rest finish the work. Concurrent runs adapt the
+    number of requests in flight to the servers' latency and 429s, and
+    transient errors are retried with backoff; requests that still fail
+    are recorded with their error and retried by the next run, and the
+    run exits with status 1. Set cache_mode to "refresh" to regenerate and
+    overwrite cached completions, or to "bypass" to neither read nor write
+    the response cache. With
+    stream=True completions are streamed and cut off once the answer's
+    closing tag arrives, and time to first token is recorded. Records are
+    tagged with run_id, a timestamp unless given, and each method's
+    records of this run are also copied into the parquet output store
+    under it.
+    """
+    base_urls = [base_url] if isinstance(base_url, str) else list(base_url)
+    run_id = run_id or new_run_id()
+    if concurrency > 1 or len(base_urls) > 1:
+        asyncio.run(main_async(model, size, base_urls, api_key, concurrency, cache_mode, stream, run_id))
+        return
+
+    cache = ResponseCache(mode=cache_mode)
+    client = OpenAI(base_url=base_urls[0], api_key=api_key, max_retries=0)
     print(f"Running benchmark for {model} with {size} prompts...\n")
+    results = []
     for method in ['base', 'cot', 'react', 'scope']:
         print(f"Running {method} method...")
-        run_benchmark(client=client, size=size, model=model, method=method)
-    print(f"\nBenchmark completed successfully!")
+        results += run_benchmark(client=client, size=size, model=model, method=method, cache=cache, stream=stream, run_id=run_id)
+        store_run(model, method, size, run_id)
+    print_cache_stats(cache)
+    cache.close()
+    display_latency_report(model, size, MODEL_OUTPUTS_DIR, run_id)
+    print_run_outcome(results)
 
 
 if __name__ == "__main__":
-    main(model="tei", size=100, base_url="http://0.0.0.0:20000/v1", api_key="sk")
+    main(model="tei", size=100, base_url="http://0.0.0.0:20000/v1", api_key="sk", concurrency=DEFAULT_CONCURRENCY)
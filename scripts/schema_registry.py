@@ -0,0 +1,128 @@
+from pathlib import Path
+import os
+import re
+import sys
+
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from scripts.problem_mappings import PROBLEM_MAPPING
+
+# Schema directories that can be selected by name
+SCHEMA_VARIANTS = {
+    "schemas": project_root / "schemas",
+    "old_schemas": project_root / "old_schemas",
+}
+
+# Variant used when callers do not pick one; override with the
+# SCOPE_SCHEMA_VARIANT environment variable instead of editing code
+DEFAULT_SCHEMA_VARIANT = os.environ.get("SCOPE_SCHEMA_VARIANT", "old_schemas")
+
+SCHEMA_FILE_PATTERN = re.compile(r"(\w*)_(schema|example)\.txt")
+
+# Schemas mark the parts that only apply to some algorithms with a line
+# "@@ algorithms: <name>, <name>" opening a section (and closing any open
+# one) and a line "@@ end" closing it. Names are PROBLEM_MAPPING keys
+SECTION_MARKER_PATTERN = re.compile(r"@@ (?:algorithms: (?P<algorithms>.+)|end)")
+
+# Cache file contents in memory, keyed by path, alongside the mtime they were read at
+FILE_CACHE: dict[Path, tuple[int, str]] = {}
+
+# Parsed sections per path, alongside the mtime of the text they were parsed from
+SECTION_CACHE: dict[Path, tuple[int, list[tuple[frozenset[str] | None, str]]]] = {}
+
+def schema_dir(variant: str | None = None) -> Path:
+    variant = variant or DEFAULT_SCHEMA_VARIANT
+    if variant not in SCHEMA_VARIANTS:
+        raise ValueError(f"Unknown schema variant: {variant} (expected one of {', '.join(SCHEMA_VARIANTS)})")
+    return SCHEMA_VARIANTS[variant]
+
+
+def read_cached(path: Path) -> str:
+    """
+    Return the contents of path, only touching the file again
+    if its mtime has changed since it was last read.
+    """
+    mtime = path.stat().st_mtime_ns
+    cached = FILE_CACHE.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path, "r") as f:
+        text = f.read()
+    FILE_CACHE[path] = (mtime, text)
+    return text
+
+
+def read_sections(path: Path) -> list[tuple[frozenset[str] | None, str]]:
+    """
+    Split a schema file into (algorithms, text) sections, where algorithms
+    is None for the parts shared by every algorithm. Marker lines are
+    dropped, so joining every section's text gives the unscoped schema.
+    """
+    text = read_cached(path)
+    mtime = FILE_CACHE[path][0]
+    cached = SECTION_CACHE.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    sections, algorithms, lines = [], None, []
+    for line in text.splitlines(keepends=True):
+        marker = SECTION_MARKER_PATTERN.fullmatch(line.rstrip("\n"))
+        if marker is None:
+            lines.append(line)
+            continue
+        if lines:
+            sections.append((algorithms, "".join(lines)))
+        lines = []
+        algorithms = None
+        if marker.group("algorithms") is not None:
+            algorithms = frozenset(name.strip() for name in marker.group("algorithms").split(","))
+            unknown = algorithms - PROBLEM_MAPPING.keys()
+            if unknown:
+                raise ValueError(f"Unknown algorithms in section marker of {path}: {', '.join(sorted(unknown))}")
+    if lines:
+        sections.append((algorithms, "".join(lines)))
+    SECTION_CACHE[path] = (mtime, sections)
+    return sections
+
+
+def read_full(path: Path) -> str:
+    """Contents of a schema or example file with its section markers removed."""
+    return "".join(text for _, text in read_sections(path))
+
+
+def read_schema(category: str, variant: str | None = None) -> str:
+    return read_full(schema_dir(variant) / f"{category}_schema.txt")
+
+
+def read_algorithm_schema(category: str, algorithm: str, variant: str | None = None) -> str:
+    """
+    The smallest schema for one algorithm: the shared parts of its category's
+    schema plus the sections scoped to it. Falls back to the whole schema
+    when no section names the algorithm, as the schema then has nothing
+    specific to it that other sections could be told apart from.
+    """
+    sections = read_sections(schema_dir(variant) / f"{category}_schema.txt")
+    if not any(algorithms is not None and algorithm in algorithms for algorithms, _ in sections):
+        return "".join(text for _, text in sections)
+    return "".join(text for algorithms, text in sections if algorithms is None or algorithm in algorithms)
+
+
+def read_example(category: str, variant: str | None = None) -> str:
+    return read_full(schema_dir(variant) / f"{category}_example.txt")
+
+
+def schema_files(variant: str | None = None) -> list[tuple[str, str, Path]]:
+    """
+    List (category, kind, path) for every schema/example file in the
+    variant's directory, where kind is either "schema" or "example".
+    """
+    directory = schema_dir(variant)
+    files = []
+    for entry in sorted(os.listdir(directory)):
+        matched = SCHEMA_FILE_PATTERN.fullmatch(entry)
+        if matched is None:
+            # not a schema/example file
+            continue
+        files.append((matched.group(1), matched.group(2), directory / entry))
+    return files
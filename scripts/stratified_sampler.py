@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+
+# Column holding each row's random sort key while sampling
+KEY_COLUMN = "_sample_key"
+
+# Default seed so that sampled datasets are reproducible
+DEFAULT_SEED = 0
+
+def allocate_quotas(quotas: dict[str, int], num_rows: int | None) -> dict[str, int]:
+    """
+    Scale quotas down so that they add up to at most num_rows, keeping
+    them proportional to the requested quotas (largest remainder method).
+    Quotas are returned unchanged if they already fit.
+    """
+    quotas = {stratum: max(int(count), 0) for stratum, count in quotas.items()}
+    total = sum(quotas.values())
+    if num_rows is None or total <= num_rows:
+        return quotas
+
+    shares = {stratum: count * num_rows / total for stratum, count in quotas.items()}
+    allocated = {stratum: int(share) for stratum, share in shares.items()}
+    leftover = num_rows - sum(allocated.values())
+    by_remainder = sorted(shares, key=lambda stratum: shares[stratum] - allocated[stratum], reverse=True)
+    for stratum in by_remainder[:leftover]:
+        allocated[stratum] += 1
+    return allocated
+
+
+def select_smallest_keys(df: pd.DataFrame, quotas: dict[str, int], by: str) -> pd.DataFrame:
+    """
+    Keep, for every value of column `by`, the quota rows with the smallest
+    sample keys. Strata without a quota are dropped.
+    """
+    ranks = df.groupby(by, sort=False)[KEY_COLUMN].rank(method="first")
+    limits = df[by].map(quotas).fillna(0)
+    return df[ranks <= limits]
+
+
+def select_smallest_keys_jointly(df: pd.DataFrame, quotas: dict[str, int], by: str, algorithm_quotas: dict[str, int]) -> pd.DataFrame:
+    """
+    Walk the rows in sample key order and keep each one whose stratum and
+    algorithm are both still under quota, so that a row only uses up an
+    algorithm's quota if it is kept. Strata without a quota are dropped;
+    algorithm quotas only cap the algorithms they name.
+    """
+    strata = df[by].to_numpy()
+    algorithms = df["algorithm"].to_numpy()
+    stratum_counts = dict.fromkeys(quotas, 0)
+    algorithm_counts = dict.fromkeys(algorithm_quotas, 0)
+    keep = np.zeros(len(df), dtype=bool)
+    for i in np.argsort(df[KEY_COLUMN].to_numpy(), kind="stable"):
+        stratum, algorithm = strata[i], algorithms[i]
+        if stratum not in stratum_counts or stratum_counts[stratum] >= quotas[stratum]:
+            continue
+        if algorithm in algorithm_counts:
+            if algorithm_counts[algorithm] >= algorithm_quotas[algorithm]:
+                continue
+            algorithm_counts[algorithm] += 1
+        stratum_counts[stratum] += 1
+        keep[i] = True
+    return df[keep]
+
+
+def select_sample(df: pd.DataFrame, quotas: dict[str, int], by: str, algorithm_quotas: dict[str, int] | None) -> pd.DataFrame:
+    if algorithm_quotas is not None:
+        return select_smallest_keys_jointly(df, quotas, by, algorithm_quotas)
+    return select_smallest_keys(df, quotas, by)
+
+
+def finalize_sample(df: pd.DataFrame) -> pd.DataFrame:
+    # ordering by sample key shuffles strata together reproducibly
+    return df.sort_values(KEY_COLUMN, kind="stable").drop(columns=KEY_COLUMN).reset_index(drop=True)
+
+
+def stratified_sample(
+    df: pd.DataFrame,
+    quotas: dict[str, int],
+    by: str = "category",
+    algorithm_quotas: dict[str, int] | None = None,
+    num_rows: int | None = None,
+    seed: int = DEFAULT_SEED,
+) -> pd.DataFrame:
+    """
+    Draw up to quotas[s] rows uniformly at random from every stratum s of
+    column `by` in a single grouped pass, optionally also capping each
+    algorithm at algorithm_quotas[algorithm], with both caps applied
+    together in sample key order. If the quotas add up to more than
+    num_rows they are scaled down proportionally first. Rows come back in
+    random order, and the same seed always gives the same sample.
+    """
+    rng = np.random.default_rng(seed)
+    keyed_df = df.assign(**{KEY_COLUMN: rng.random(len(df))})
+    sampled_df = select_sample(keyed_df, allocate_quotas(quotas, num_rows), by, algorithm_quotas)
+    return finalize_sample(sampled_df)
+
+
+class ReservoirSampler:
+    """
+    Streaming version of stratified_sample for input that arrives in
+    chunks (e.g. one parquet shard or record batch at a time). Only the
+    current sample plus one chunk is held in memory. Fed the chunks of a
+    frame in order, it draws the same sample as stratified_sample does on
+    the whole frame with the same seed. With algorithm_quotas that is not
+    guaranteed: a row dropped from an earlier chunk's sample is never
+    reconsidered, although rows arriving later can free its quota.
+    """
+    def __init__(
+        self,
+        quotas: dict[str, int],
+        by: str = "category",
+        algorithm_quotas: dict[str, int] | None = None,
+        num_rows: int | None = None,
+        seed: int = DEFAULT_SEED,
+    ):
+        self.quotas = allocate_quotas(quotas, num_rows)
+        self.by = by
+        self.algorithm_quotas = algorithm_quotas
+        self.rng = np.random.default_rng(seed)
+        self.sample = None
+
+    def add(self, chunk: pd.DataFrame) -> None:
+        keyed_chunk = chunk.assign(**{KEY_COLUMN: self.rng.random(len(chunk))})
+        if self.sample is not None:
+            keyed_chunk = pd.concat([self.sample, keyed_chunk], ignore_index=True)
+        self.sample = select_sample(keyed_chunk, self.quotas, self.by, self.algorithm_quotas)
+
+    def result(self) -> pd.DataFrame:
+        if self.sample is None:
+            return pd.DataFrame()
+        return finalize_sample(self.sample)
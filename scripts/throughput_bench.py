@@ -0,0 +1,138 @@
+from pathlib import Path
+import sys
+import asyncio
+import contextlib
+import io
+import tempfile
+import time
+import pandas as pd
+
+# add project root to Python path to allow imports
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from scripts.latency_report import METRIC_COLUMNS, summarize_requests
+from scripts.mock_server import MockServer
+from scripts.endpoint_pool import EndpointPool
+from scripts.flow_control import AIMDLimiter
+from scripts.output_records import is_failure
+from scripts.run_bench import run_benchmark_async
+
+# Concurrency levels the runner is measured at by default
+DEFAULT_CONCURRENCY_LEVELS = (1, 4, 16, 64)
+
+async def measure_concurrency(base_url: str, method: str, size: int, concurrency: int, stream: bool, adaptive: bool) -> dict:
+    """
+    Run one benchmark against base_url at the given concurrency, writing its
+    outputs to a scratch directory and bypassing the response cache, and
+    summarize the throughput and latency the runner achieved. Unless
+    adaptive, the concurrency is held fixed instead of being a cap for the
+    runner's AIMD limiter.
+    """
+    if adaptive:
+        limiter = AIMDLimiter(max(1, concurrency // 4), max_limit=concurrency)
+    else:
+        limiter = AIMDLimiter(concurrency, min_limit=concurrency, max_limit=concurrency)
+    with tempfile.TemporaryDirectory() as outputs_dir:
+        async with EndpointPool([base_url], "sk", concurrency) as pool:
+            start = time.perf_counter()
+            # the runner prints every model output, which is only noise here
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = await run_benchmark_async(
+                    pool=pool, model="mock", method=method, size=size,
+                    concurrency=concurrency, cache=None, stream=stream, outputs_dir=Path(outputs_dir), limiter=limiter,
+                )
+            wall_time = time.perf_counter() - start
+
+    # failed requests carry no metrics, and a level where all of them
+    # failed would otherwise leave the frame without the metric columns
+    summary = summarize_requests(pd.DataFrame(results, columns=METRIC_COLUMNS)).to_dict()
+    summary["failed"] = sum(1 for result in results if is_failure(result))
+    summary["wall_time"] = wall_time
+    summary["peak_limit"] = limiter.stats()["peak_limit"]
+    return {"concurrency": concurrency, **summary}
+
+
+def run_throughput_bench(
+    method: str = "scope",
+    size: int = 100,
+    concurrency_levels: tuple[int, ...] = DEFAULT_CONCURRENCY_LEVELS,
+    stream: bool = False,
+    adaptive: bool = False,
+    **server_options,
+) -> pd.DataFrame:
+    """
+    Measure run_bench against a local MockServer at each concurrency level.
+    server_options (latency, latency_dist, token_delay, rate_limit_rate,
+    error_rate, seed) are passed to the server; port 0 picks a free port.
+    """
+    rows = []
+    with MockServer(port=server_options.pop("port", 0), **server_options) as server:
+        for concurrency in concurrency_levels:
+            rows.append(asyncio.run(measure_concurrency(server.base_url, method, size, concurrency, stream, adaptive)))
+        server_stats = server.stats()
+    print(f"Mock server: {server_stats['requests']} requests, {server_stats['rate_limited']} answered 429, {server_stats['errors']} answered 500")
+    return pd.DataFrame(rows).set_index("concurrency")
+
+
+def display_throughput_bench(table: pd.DataFrame) -> None:
+    columns = ["requests", "failed", "retries", "peak_limit", "wall_time", "requests_per_s", "tokens_per_s", "p50_latency", "p95_latency", "p99_latency", "mean_queue_time"]
+    with pd.option_context("display.float_format", "{:.3f}".format, "display.width", 200, "display.max_columns", None):
+        print()
+        print("#########################")
+        print("### RUNNER THROUGHPUT ###")
+        print("#########################")
+        print(table[columns])
+
+
+def print_usage() -> None:
+    print(
+"""Usage: python throughput_bench.py [options]
+Arguments:
+  --method | -m <method> - Benchmark method to run (defaults to scope)
+  --size | -n <size> - Benchmark size to run (defaults to 100)
+  --concurrency | -c <levels> - Comma separated concurrency levels (defaults to 1,4,16,64)
+  --latency | -l <seconds> - Mean time to first token of the mock server (defaults to 0.05)
+  --latency-dist | -d <dist> - One of constant, uniform, exponential, lognormal (defaults to constant)
+  --token-delay | -t <seconds> - Time per generated token (defaults to 0)
+  --rate-limit-rate <fraction> - Fraction of requests answered with 429 (defaults to 0)
+  --error-rate <fraction> - Fraction of requests answered with 500 (defaults to 0)
+  --stream - Stream completions and stop at the closing answer tag
+  --adaptive - Let the runner adapt its concurrency, up to each level, instead of holding it fixed
+Example usage: python throughput_bench.py --size 100 --concurrency 1,8,32 --latency 0.2 --latency-dist lognormal"""
+    )
+
+
+def parse_args() -> dict:
+    args = sys.argv[1:]
+    options = {
+        "--method": ("method", str), "-m": ("method", str),
+        "--size": ("size", int), "-n": ("size", int),
+        "--concurrency": ("concurrency_levels", lambda levels: tuple(int(level) for level in levels.split(","))),
+        "-c": ("concurrency_levels", lambda levels: tuple(int(level) for level in levels.split(","))),
+        "--latency": ("latency", float), "-l": ("latency", float),
+        "--latency-dist": ("latency_dist", str), "-d": ("latency_dist", str),
+        "--token-delay": ("token_delay", float), "-t": ("token_delay", float),
+        "--rate-limit-rate": ("rate_limit_rate", float),
+        "--error-rate": ("error_rate", float),
+    }
+    config = {}
+    i = 0
+    while i < len(args):
+        if args[i] in ("--stream", "--adaptive"):
+            # flags without a value
+            config[args[i][2:]] = True
+            i += 1
+            continue
+        if args[i] not in options or i + 1 >= len(args):
+            print(f"Error: Invalid argument: {args[i]}\n")
+            print_usage()
+            sys.exit(1)
+        key, convert = options[args[i]]
+        config[key] = convert(args[i+1])
+        i += 2
+    return config
+
+
+if __name__ == "__main__":
+    display_throughput_bench(run_throughput_bench(**parse_args()))
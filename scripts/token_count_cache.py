@@ -0,0 +1,111 @@
+from pathlib import Path
+import hashlib
+import sqlite3
+import time
+
+project_root = Path(__file__).parent.parent
+
+CACHE_FILE = project_root / ".cache" / "token_counts.sqlite"
+
+# Upper bound on the number of cached token counts
+DEFAULT_MAX_ENTRIES = 2_000_000
+
+# SQLite limits the number of parameters in one statement
+QUERY_CHUNK_SIZE = 500
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    Identify a tokenizer version by hashing its serialized definition
+    (vocab, merges, normalizers...), so that an updated tokenizer under
+    the same model id never reuses stale counts.
+    """
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        definition = backend.to_str()
+    else:
+        definition = f"{type(tokenizer).__name__}:{tokenizer.name_or_path}:{len(tokenizer)}"
+    return hashlib.sha256(definition.encode("utf-8")).hexdigest()[:16]
+
+
+class TokenCountCache:
+    """
+    On-disk SQLite cache of token counts keyed by (model_id, tokenizer
+    fingerprint, sha256 of text). Least recently used counts are evicted
+    once more than `max_entries` are stored.
+    """
+    def __init__(self, path: Path = CACHE_FILE, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS token_counts (
+                model_id TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model_id, fingerprint, text_hash)
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS token_counts_last_used ON token_counts (last_used)")
+        self.conn.commit()
+        self.num_entries = self.conn.execute("SELECT COUNT(*) FROM token_counts").fetchone()[0]
+
+    def get_many(self, model_id: str, fingerprint: str, hashes: list[str]) -> dict[str, int]:
+        found = {}
+        for start in range(0, len(hashes), QUERY_CHUNK_SIZE):
+            chunk = hashes[start:start + QUERY_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT text_hash, count FROM token_counts "
+                f"WHERE model_id = ? AND fingerprint = ? AND text_hash IN ({placeholders})",
+                (model_id, fingerprint, *chunk),
+            ).fetchall()
+            found.update(rows)
+
+        now = time.time()
+        self.conn.executemany(
+            "UPDATE token_counts SET last_used = ? WHERE model_id = ? AND fingerprint = ? AND text_hash = ?",
+            [(now, model_id, fingerprint, h) for h in found],
+        )
+        self.conn.commit()
+        self.hits += len(found)
+        self.misses += len(hashes) - len(found)
+        return found
+
+    def put_many(self, model_id: str, fingerprint: str, counts: dict[str, int]) -> None:
+        now = time.time()
+        before = self.conn.total_changes
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO token_counts (model_id, fingerprint, text_hash, count, last_used) VALUES (?, ?, ?, ?, ?)",
+            [(model_id, fingerprint, h, count, now) for h, count in counts.items()],
+        )
+        self.num_entries += self.conn.total_changes - before
+        self.evict()
+        self.conn.commit()
+
+    def evict(self) -> None:
+        excess = self.num_entries - self.max_entries
+        if excess <= 0:
+            return
+        self.conn.execute(
+            "DELETE FROM token_counts WHERE rowid IN "
+            "(SELECT rowid FROM token_counts ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+        self.num_entries -= excess
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": self.num_entries}
+
+    def close(self) -> None:
+        self.conn.close()
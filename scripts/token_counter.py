@@ -0,0 +1,137 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+from pathlib import Path
+import sys
+from transformers import AutoTokenizer
+from typing import Any
+
+# add project root to Python path to allow imports
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from scripts.token_count_cache import TokenCountCache, text_hash, tokenizer_fingerprint
+
+# Default tokenizer is GPT-2 BPE tokenizer
+DEFAULT_MODEL_ID = "gpt2"
+
+# Number of texts handed to the fast tokenizer in one batch encode call
+DEFAULT_BATCH_SIZE = 1024
+
+# Inputs with at least this many texts are sharded across a process pool
+PARALLEL_THRESHOLD = 50_000
+
+# Cache used tokenizers in memory for quick retrieval
+TOKENIZER_CACHE: dict[str, Any] = {}
+
+# Tokenizer fingerprints per model id, since serializing a tokenizer is not free
+FINGERPRINT_CACHE: dict[str, str] = {}
+
+# On-disk token count cache, opened on first use
+TOKEN_COUNT_CACHE: TokenCountCache | None = None
+
+def retrieve_tokenizer(model_id: str) -> Any:
+    """
+    Search for loaded tokenizer in cache.
+    If not present, load the tokenizer for
+    model_id from huggingface.
+    """
+    if model_id in TOKENIZER_CACHE:
+        return TOKENIZER_CACHE[model_id]
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    TOKENIZER_CACHE[model_id] = tokenizer
+    return tokenizer
+
+
+def count_tokens_serial(texts: list[str], model_id: str, batch_size: int = DEFAULT_BATCH_SIZE) -> list[int]:
+    tokenizer = retrieve_tokenizer(model_id)
+    counts = []
+    for start in range(0, len(texts), batch_size):
+        encoded = tokenizer(
+            texts[start:start + batch_size],
+            add_special_tokens=True,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        )
+        counts.extend(len(ids) for ids in encoded["input_ids"])
+    return counts
+
+
+def init_worker() -> None:
+    # each worker is already one of many processes, so keep the
+    # tokenizer's own thread pool from oversubscribing the cpus
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+
+def encode_token_counts(texts: list[str], model_id: str, batch_size: int, num_workers: int | None) -> list[int]:
+    num_workers = num_workers or os.cpu_count() or 1
+    if len(texts) < PARALLEL_THRESHOLD or num_workers == 1:
+        return count_tokens_serial(texts, model_id, batch_size)
+
+    shard_size = -(-len(texts) // num_workers)
+    shards = [texts[start:start + shard_size] for start in range(0, len(texts), shard_size)]
+    # spawn rather than fork: forking after the tokenizer's thread pool has
+    # been used can deadlock, and each worker loads its own tokenizer anyway
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context, initializer=init_worker) as pool:
+        shard_counts = pool.map(
+            count_tokens_serial,
+            shards,
+            [model_id] * len(shards),
+            [batch_size] * len(shards),
+        )
+        return [count for counts in shard_counts for count in counts]
+
+
+def retrieve_token_count_cache() -> TokenCountCache:
+    global TOKEN_COUNT_CACHE
+    if TOKEN_COUNT_CACHE is None:
+        TOKEN_COUNT_CACHE = TokenCountCache()
+    return TOKEN_COUNT_CACHE
+
+
+def retrieve_fingerprint(model_id: str) -> str:
+    if model_id not in FINGERPRINT_CACHE:
+        FINGERPRINT_CACHE[model_id] = tokenizer_fingerprint(retrieve_tokenizer(model_id))
+    return FINGERPRINT_CACHE[model_id]
+
+
+def count_tokens(
+    texts: list[str],
+    model_id: str = DEFAULT_MODEL_ID,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    num_workers: int | None = None,
+    use_cache: bool = True,
+) -> list[int]:
+    """
+    Compute the number of tokens in each of the given texts using the
+    tokenizer for model_id, in the same order. Counts already in the
+    on-disk token count cache are reused; the remaining distinct texts are
+    encoded in batches, and inputs of PARALLEL_THRESHOLD texts or more are
+    split into shards that are encoded on a pool of num_workers processes
+    (defaults to the cpu count, 1 disables the pool).
+    """
+    texts = list(texts)
+    if not use_cache:
+        return encode_token_counts(texts, model_id, batch_size, num_workers)
+
+    cache = retrieve_token_count_cache()
+    fingerprint = retrieve_fingerprint(model_id)
+    hashes = [text_hash(text) for text in texts]
+    known = cache.get_many(model_id, fingerprint, list(dict.fromkeys(hashes)))
+
+    missing = {h: text for h, text in zip(hashes, texts) if h not in known}
+    if missing:
+        new_counts = dict(zip(missing, encode_token_counts(list(missing.values()), model_id, batch_size, num_workers)))
+        cache.put_many(model_id, fingerprint, new_counts)
+        known.update(new_counts)
+
+    return [known[h] for h in hashes]
+
+
+def compute_token_count(text: str, model_id: str = DEFAULT_MODEL_ID) -> int:
+    """
+    Compute the number of tokens in the given text using the tokenizer
+    for model_id.
+    """
+    return count_tokens([text], model_id)[0]
@@ -1,35 +1,38 @@
 from pathlib import Path
-import os
 import sys
-import pandas as pd
 import json
 import re
-from transformers import AutoTokenizer
-from typing import Any
+from collections import defaultdict
+import numpy as np
 
 # add project root to Python path to allow imports
 project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
-from tools.sampling.problem_mappings import ProblemType, PROBLEMM_TYPES, PROBLEM_MAPPING
-from tools.sampling.prepare_clrs_dataset import prepare_clrs_dataset
+from scripts.problem_mappings import ProblemType, PROBLEM_TYPES
+from scripts.output_records import iter_outputs
+from scripts.benchmark_store import benchmark_items_by_id, render_prompt
+from scripts.eval_bench import OUTPUT_FILE_PATTERN
+from scripts.token_counter import DEFAULT_MODEL_ID, count_tokens
 
-# Default tokenizer is GPT-2 BPE tokenizer
-DEFAULT_MODEL_ID = "gpt2"
+BENCH_DIR = project_root / "benchmark_datasets"
+
+# Number of records whose token efficiencies are computed in one batch
+TRACE_BATCH_SIZE = 512
+
+# Resolution of the token efficiency histograms used for percentiles
+HISTOGRAM_BINS = 1000
 
 # Compile answer pattern to speed up regex matches, since we do a lot
 ANSWER_PATTERN = re.compile(r'<answer>.*</answer>')
 
-# Cache used tokenizers in memory for quick retrieval
-TOKENIZER_CACHE: dict[str, Any] = {}
-
 def extract_useful_output_tokens(output: str) -> str:
     """
     Useful output from model response is just the answer.
     Extract the substring from output matching the answer
     with <answer>/</answer> tags.
     """
-    matched_answer = ANSWER_PATTERN.match(output)
+    matched_answer = ANSWER_PATTERN.search(output)
     if matched_answer is None:
         # Missing answer tags should not happen
         # Default to outputting empty string in this case;
@@ -38,87 +41,141 @@ def extract_useful_output_tokens(output: str) -> str:
     return matched_answer.group(0)
 
 
-def retrieve_tokenizer(model_id: str) -> Any:
+def compute_token_efficiencies(prompts: list[str], outputs: list[str], model_id: str = DEFAULT_MODEL_ID) -> list[float]:
     """
-    Search for loaded tokenizer in cache.
-    If not present, load the tokenizer for
-    model_id from huggingface.
+    Compute token efficiency as the ratio of useful tokens to full tokens
+    for every (prompt, output) pair. Useful tokens are the tokens in the
+    output that are part of the answer. Full tokens are the sum of the
+    tokens in the prompt and output. All texts are counted in one batch.
     """
-    if model_id in TOKENIZER_CACHE:
-        return TOKENIZER_CACHE[model_id]
-    tokenizer = AutoTokenizer.from_pretrained(model_id) 
-    TOKENIZER_CACHE[model_id] = tokenizer
-    return tokenizer
-
+    useful_outputs = [extract_useful_output_tokens(output) for output in outputs]
+    counts = count_tokens(list(prompts) + list(outputs) + useful_outputs, model_id)
+    n = len(prompts)
+    prompt_counts, output_counts, useful_counts = counts[:n], counts[n:2 * n], counts[2 * n:]
+
+    efficiencies = []
+    for prompt_count, output_count, useful_count in zip(prompt_counts, output_counts, useful_counts):
+        full_token_count = prompt_count + output_count
+        # default to 0 for empty prompt/output to handle possible edge cases
+        efficiencies.append(useful_count / full_token_count if full_token_count else 0)
+    return efficiencies
 
-def compute_token_count(text: str, model_id: str) -> int:
-    """
-    Compute the number of tokens in the given text using the tokenizer
-    for model_id.
-    """
-    # get tokenizer for model_id
-    tokenizer = retrieve_tokenizer(model_id)
-    # encode prompt, output and useful output
-    encoded_text = tokenizer.encode(text, add_special_tokens=True)
 
-    return len(encoded_text)
+def compute_token_efficiency(prompt: str, output: str, model_id: str = DEFAULT_MODEL_ID) -> float:
+    return compute_token_efficiencies([prompt], [output], model_id)[0]
 
 
-def compute_token_efficiency(prompt: str, output: str, model_id: str = DEFAULT_MODEL_ID) -> float:
+class EfficiencyStats:
     """
-    Compute token efficiency as the ratio of useful tokens to full tokens.
-    Useful tokens are the tokens in the output that are part of the answer.
-    Full tokens are the sum of the tokens in the prompt and output.
+    Running count, mean and percentiles of token efficiencies. Efficiencies
+    lie in [0, 1], so percentiles are read off a fixed-size histogram and
+    memory stays constant however many values are added.
     """
-    full_token_count = compute_token_count(prompt, model_id=model_id) + compute_token_count(output, model_id=model_id) 
-    useful_token_count = compute_token_count(extract_useful_output_tokens(output), model_id=model_id)
-    
-    if full_token_count == 0:
-        # default to 0 for empty prompt/output to handle possible edge cases
-        return 0
-
-    return useful_token_count / full_token_count
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+
+    def add(self, values: list[float]) -> None:
+        values = np.clip(np.asarray(values, dtype=np.float64), 0.0, 1.0)
+        self.count += len(values)
+        self.total += float(values.sum())
+        bins = np.minimum((values * HISTOGRAM_BINS).astype(np.int64), HISTOGRAM_BINS - 1)
+        self.histogram += np.bincount(bins, minlength=HISTOGRAM_BINS)
+
+    def percentile(self, q: float) -> float:
+        if self.count == 0:
+            return float("nan")
+        # nearest-rank percentile, reported as the midpoint of its bin
+        rank = max(int(np.ceil(q / 100 * self.count)), 1)
+        bin_idx = int(np.searchsorted(np.cumsum(self.histogram), rank))
+        return (bin_idx + 0.5) / HISTOGRAM_BINS
+
+    def summary(self) -> dict[str, float | int]:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else float("nan"),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+        }
+
+
+def benchmark_items(json_file: Path|str, bench_dir: Path = BENCH_DIR) -> dict[str, dict] | None:
+    """
+    Items of the benchmark an output file was run on, keyed by prompt id.
+    run_bench names output files <model>_<method>_<size>.jsonl after
+    benchmark_<method>_<size>. None if the name does not match or the
+    benchmark is not built.
+    """
+    matched = OUTPUT_FILE_PATTERN.fullmatch(Path(json_file).name)
+    if matched is None:
+        return None
+    return benchmark_items_by_id(bench_dir, matched["method"], int(matched["size"]))
 
 
-def stat_traces(json_file: Path|str, model_id: str = DEFAULT_MODEL_ID, save_path: Path|str = None) -> dict[ProblemType, int]:
+def stat_traces(json_file: Path|str, model_id: str = DEFAULT_MODEL_ID, save_path: Path|str = None, bench_dir: Path = BENCH_DIR) -> dict[str, dict[str, dict[str, float | int]]]:
     """
-    Takes in path to a json file that holds the results of model outputs
-    generated by test_model.py. Computes the token efficiencies for model
-    outputs produced by model_id. Groups token efficiencies by algo_name 
-    and aggregates examples in each group by taking the mean.
-    The file must be a json file with the following fields: prompt,
-    model_output, algo_name, i.e. records must have the following shape:
+    Takes in path to a json/jsonl file that holds the results of model
+    outputs generated by run_bench.py. Computes the token efficiencies for
+    model outputs produced by model_id in batches, and keeps a running
+    count, mean, p50 and p95 per category and per algorithm. Records are
+    streamed one at a time, so memory does not grow with the file; those
+    of failed requests are skipped, and the rest must have the following shape:
     {
-        prompt: "...",
+        id: "...",
         model_output: "...",
-        algo_name: "...",
+        category: "...",
+        algorithm: "...",
         ...
     }
+    The prompt of a record is looked up by its id in the benchmark it was
+    run on, unless the record stores it under "prompt" (legacy outputs).
+    Records whose id is not in the current build of the benchmark are left
+    by an earlier build and skipped.
     """
-    req_cols = ("prompt", "model_output")
-    def check_cols(df: pd.DataFrame):
-        if any(c not in df.columns for c in req_cols):
-            raise ValueError("Invalid json: Missing prompt/model_output attributes in records")
-
-    with open(json_file, "r") as f:
-        df = pd.read_json(f, orient="records")
-        check_cols(df)
-
-    def add_trace(record: pd.Series) -> pd.Series:
-        # create a row copy to avoid mutating original df
-        record_copy = record.copy()
-        # compute token efficiency and add as column to record copy
-        prompt, output = record["prompt"], record["model_outputs"]
-        tok_eff = compute_token_efficiency(prompt, output, model_id)
-        record_copy["token_efficiency"] = tok_eff
-        return record_copy
-
-    add_trace = lambda rec: rec.copy()["token_efficiency"] = compute_token_efficiency(rec["prompt"], rec["model_outputs"], model_id)
-    df_with_trace_stats = df.apply(add_trace, axis=1) 
+    items = benchmark_items(json_file, bench_dir)
+    def prompt_of(record: dict) -> str:
+        if "prompt" in record:
+            return record["prompt"]
+        if items is None:
+            raise ValueError(f"Records in {json_file} have no prompt and there is no benchmark to look them up in")
+        return render_prompt(items[record["id"]])
+
+    category_stats = defaultdict(EfficiencyStats)
+    algorithm_stats = defaultdict(EfficiencyStats)
+    def add_batch(batch: list[dict]):
+        efficiencies = compute_token_efficiencies(
+            [prompt_of(record) for record in batch],
+            [record["model_output"] for record in batch],
+            model_id,
+        )
+        by_category, by_algorithm = defaultdict(list), defaultdict(list)
+        for record, tok_eff in zip(batch, efficiencies):
+            by_category[record.get("category")].append(tok_eff)
+            by_algorithm[record.get("algorithm")].append(tok_eff)
+        for category, values in by_category.items():
+            category_stats[category].add(values)
+        for algorithm, values in by_algorithm.items():
+            algorithm_stats[algorithm].add(values)
+
+    batch = []
+    for record in iter_outputs(json_file, None if items is None else items.keys()):
+        batch.append(record)
+        if len(batch) == TRACE_BATCH_SIZE:
+            add_batch(batch)
+            batch = []
+    if batch:
+        add_batch(batch)
 
     trace_stats = {
-        ptype: df_with_trace_stats[df_with_trace_stats["algo_name"] == ptype]["token_efficiency"].mean()
-        for ptype in PROBLEM_TYPES
+        "categories": {
+            ptype: category_stats[ptype].summary()
+            for ptype in PROBLEM_TYPES
+        },
+        "algorithms": {
+            algorithm: stats.summary()
+            for algorithm, stats in sorted(algorithm_stats.items(), key=lambda item: str(item[0]))
+        },
     }
 
     if save_path is not None:
@@ -132,7 +189,7 @@ def print_usage() -> None:
     print(
 """Usage: python trace_stats.py <json_file> <save_path> [<model_id>]
 Arguments:
-  <json_file> - Path to json file containing model outputs
+  <json_file> - Path to json file containing model outputs, named <model>_<method>_<size>.jsonl as run_bench writes it
   <save_path> - Path to save the trace statistics to
   <model_id> - Model id to compute token efficiencies for (optional, defaults to gpt2)
 Example usage: python trace_stats.py model_responses.json trace_stats.json tei"""
@@ -155,6 +212,6 @@ if __name__ == "__main__":
     trace_stats = stat_traces(**config)
 
     print(f"Trace statistics computed for model {config.get('model_id', DEFAULT_MODEL_ID)} from {config['json_file']}:")
-    for ptype, stat in trace_stats.items():
-        print(f"  {ptype}: {stat:.2f} token efficiency (average)")
+    for ptype, stat in trace_stats["categories"].items():
+        print(f"  {ptype}: {stat['mean']:.2f} token efficiency (average), p50 {stat['p50']:.2f}, p95 {stat['p95']:.2f} ({stat['count']} records)")
     print(f"Saved trace statistics to {config['save_path']}")